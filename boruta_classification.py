@@ -6,7 +6,6 @@ import math
 import exceptions
 import multiprocessing
 import numpy as np
-import pandas as pd
 import random
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.tree import DecisionTreeClassifier
@@ -127,12 +126,13 @@ def run_boruta(X, y, p):
 
 def read_typedata(chrlist, outdir, p, run, type):
 
-    ch = chrlist[0]
-    X = np.load('%sX_%s_chr%d_%d_%d.npy' % (outdir, type, ch, p, run))
-
-    for ch in chrlist[1:]:
-
-        X = np.concatenate((X, np.load('%sX_%s_chr%d_%d_%d.npy' % (outdir, type, ch, p, run))), axis=1)
+    # shapes are read from headers of npy files, genome-wide matrix is allocated once and filled by chromosomes
+    parts = [np.load('%sX_%s_chr%d_%d_%d.npy' % (outdir, type, ch, p, run), mmap_mode='r') for ch in chrlist]
+    X = np.empty(shape=(parts[0].shape[0], sum([part.shape[1] for part in parts])), dtype=np.result_type(*parts))
+    col = 0
+    for part in parts:
+        X[:, col:col+part.shape[1]] = part
+        col += part.shape[1]
 
     y = np.load('%sy_%s_%d.npy' % (outdir, type, run))
 
@@ -153,7 +153,8 @@ def build_data(borutarun, chrlist, classrun, dataset, frombed, newforest_notcv,
         testpat = None
         trainpat = list(range(patients))
 
-    X, X_test = None, None
+    # numbers of selected SNPs of all chromosomes are known first, so genome-wide matrices are allocated once
+    selected = []
     for ch in chrlist:
         if frombed:
             selected_snps = {
@@ -164,17 +165,16 @@ def build_data(borutarun, chrlist, classrun, dataset, frombed, newforest_notcv,
             }
         else:
             selected_snps = read_selected_snps(ch, dataset, frombed, outdir, p, borutarun, snpsubset, snpruns, testset)
+        selected.append(selected_snps)
 
-        xx, xx_test, snp = funcs.read_Xs(ch, testset, len(next(iter(selected_snps.values()))), selected_snps, testpat, trainpat)
-
-        if X is None:
-            X = xx.copy()
-            if xx_test is not None:
-                X_test = xx_test.copy()
-        else:
-            X = np.concatenate((X, xx), axis=1)
-            if xx_test is not None:
-                X_test = np.concatenate((X_test, xx_test), axis=1)
+    snps = [len(next(iter(selected_snps.values()))) for selected_snps in selected]
+    X = np.zeros(shape=(len(trainpat), sum(snps)), dtype=np.int8)
+    X_test = np.zeros(shape=(len(testpat), sum(snps)), dtype=np.int8) if testpat else None
+    col = 0
+    for ch, selected_snps, snp in zip(chrlist, selected, snps):
+        funcs.read_Xs(ch, testset, snp, selected_snps, testpat, trainpat, X[:, col:col+snp],
+                      X_test[:, col:col+snp] if X_test is not None else None)
+        col += snp
 
     y, y_test = build_y_matrices(testset, None, outdir, pat, testpat, trainpat, testing=True)
     return X, y, X_test, y_test, patients
@@ -466,28 +466,15 @@ def build_y_matrices(dataset, run, outdir, pat, testpat, trainpat, testing=False
             except FileNotFoundError:
                 pass
 
+    # diagnoses of all data sets are taken from their manifests, patients are selected by boolean masks
+    y = funcs.diagnoses(dataset, pat)
+    train = funcs.selection_mask(trainpat, len(y))
     y_train = np.zeros(shape=(len(trainpat),), dtype=np.int8)
+    y_train[:train.sum()] = y[train]
     if testpat:
         y_test = np.zeros(shape=(len(testpat),), dtype=np.int8)
-
-    train_row = 0
-    test_row = 0
-    done = 0
-
-    for name, directory in dataset.items():
-
-        y = pd.read_csv('%smatrices/Y_chr.csv' % directory, header=None, index_col=0).values
-        y = y.ravel()
-
-        for i in range(pat[name]):
-            if (done + i) in trainpat:
-                y_train[train_row] = y[i]
-                train_row += 1
-            elif (done + i) in testpat:
-                y_test[test_row] = y[i]
-                test_row += 1
-
-        done += i + 1
+        test = funcs.selection_mask(testpat, len(y)) & ~train
+        y_test[:test.sum()] = y[test]
 
     if not testing:
         np.save('%sy_train_%d.npy' % (outdir, run), y_train)
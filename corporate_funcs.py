@@ -1,7 +1,22 @@
 import exceptions
 import numpy as np
-import csv
+import hashlib
+import io
 import os
+import pandas as pd
+import struct
+
+# header of packed genotype file (.gtp): magic string, number of patients, number of SNPs
+PACKED_MAGIC = b'GTP\x01'
+PACKED_HEADER = len(PACKED_MAGIC) + 8
+# 2-bit code -> genotype value, code 3 marks missing call
+PACKED_VALUES = np.array([0, 1, 2, -1], dtype=np.int8)
+
+# files of data set (in its matrices directory) summarized in manifest
+MANIFEST = 'manifest.npz'
+MANIFEST_SOURCES = ['genome_stats.txt', 'Y_chr.csv', 'pid_chr.txt']
+# manifests already loaded by this process: matrices directory -> manifest
+_manifests = {}
 
 
 def establish_run(analysistype, fixed, outdir, run):
@@ -163,6 +178,164 @@ def read_chrstr(chrstr):
     return chrlist
 
 
+def save_csv(X, filename, rows=1000):
+    """
+    Writing genotype matrix into csv file in the text format used before binary files - header with numbers of columns,
+    first column with numbers of rows. Matrix is written in blocks of rows, so it can be memory-mapped.
+    """
+    with open(filename, 'w') as f:
+        f.write(',' + ','.join(list(map(str, range(X.shape[1])))) + '\n')
+        for start in range(0, X.shape[0], rows):
+            block = np.asarray(X[start:start+rows])
+            np.savetxt(f, np.column_stack((np.arange(start, start+block.shape[0]), block)), fmt='%d', delimiter=',')
+
+
+def pack_genotypes(X):
+    """
+    Packing genotype matrix into 2 bits per call (similar to PLINK .bed file). Packed matrix is SNP-major: every row
+    is one SNP and every byte holds 4 patients (the first patient in the lowest bits). Values 0, 1 and 2 are written
+    as they are, missing call (-1) as 3 - so missing calls are marked by both bits set (see missing_bitmask).
+    :param X: (ndarray) matrix patients x SNPs with values -1, 0, 1, 2
+    :return: (ndarray) uint8 matrix of shape (SNPs, ceil(patients/4))
+    """
+    X = np.asarray(X)
+    if X.size and (X.min() < -1 or X.max() > 2):
+        raise exceptions.WrongValueError('X', '[%d, %d]' % (X.min(), X.max()),
+                                         'Only values -1, 0, 1 and 2 can be written into packed matrix.')
+    X = np.asarray(X, dtype=np.int8)
+    pat, snp = X.shape
+    codes = np.zeros(shape=(snp, (pat + 3) // 4 * 4), dtype=np.uint8)
+    codes[:, :pat] = X.T.view(np.uint8) & 3
+    codes = codes.reshape(snp, -1, 4)
+    return codes[:, :, 0] | (codes[:, :, 1] << 2) | (codes[:, :, 2] << 4) | (codes[:, :, 3] << 6)
+
+
+def unpack_genotypes(packed, pat, rows=None, cols=None):
+    """
+    Unpacking (part of) packed genotype matrix.
+    :param packed: (ndarray) packed matrix, output of pack_genotypes or load_packed
+    :param pat: (int) number of patients
+    :param rows: (list) patients which should be unpacked, all if None
+    :param cols: (list) SNPs which should be unpacked, all if None
+    :return: (ndarray) int8 matrix patients x SNPs
+    """
+    if rows is None:
+        rows = np.arange(pat)
+    rows = np.asarray(rows, dtype=np.int64)
+    if cols is not None:
+        packed = packed[np.asarray(cols, dtype=np.int64)]
+    codes = (np.asarray(packed[:, rows // 4]) >> (2 * (rows % 4)).astype(np.uint8)) & 3
+    return PACKED_VALUES[codes.T]
+
+
+def missing_bitmask(packed):
+    """
+    Bitmask of missing calls in packed matrix - for every byte bit 2*k is set if k-th patient in this byte has no call.
+    """
+    packed = np.asarray(packed)
+    return packed & (packed >> 1) & 0x55
+
+
+def save_packed(filename, pat, snp, blocks):
+    """
+    Writing genotype matrix into packed file (.gtp).
+    :param filename: (str) name of output file
+    :param pat: (int) number of patients
+    :param snp: (int) number of SNPs
+    :param blocks: (iterable) SNP-major blocks of matrix (SNPs x patients), e.g. [X.T] for whole matrix X
+    """
+    with open(filename, 'wb') as f:
+        f.write(PACKED_MAGIC + struct.pack('<II', pat, snp))
+        for block in blocks:
+            pack_genotypes(block.T).tofile(f)
+
+
+def load_packed(filename):
+    """
+    Opening packed genotype file (memory-mapped).
+    :return: packed matrix, number of patients, number of SNPs
+    """
+    with open(filename, 'rb') as f:
+        header = f.read(PACKED_HEADER)
+    if header[:len(PACKED_MAGIC)] != PACKED_MAGIC:
+        raise exceptions.OtherError('File %s is not packed genotype file!' % filename)
+    pat, snp = struct.unpack('<II', header[len(PACKED_MAGIC):])
+    packed = np.memmap(filename, dtype=np.uint8, mode='r', offset=PACKED_HEADER, shape=(snp, (pat + 3) // 4))
+    return packed, pat, snp
+
+
+def append_rows(filename, X):
+    """
+    Appending rows (patients) to matrix in npy file in place - the matrix is C-ordered, so new rows are written at
+    the end of the file and only the shape in the header is changed (the whole file is rewritten only if the new
+    header is longer than the old one).
+    :param filename: (str) name of npy file
+    :param X: (ndarray) matrix with new rows, the same number of columns and type as the matrix in the file
+    :return: (tuple) new shape of the matrix
+    """
+    with open(filename, 'rb') as f:
+        if np.lib.format.read_magic(f) == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    X = np.asarray(X, dtype=dtype)
+    if fortran or len(shape) != 2 or X.shape[1] != shape[1]:
+        raise exceptions.WrongValueError('X', str(X.shape), 'Rows cannot be appended to matrix of shape %s in %s.' %
+                                         (str(shape), filename))
+    shape = (shape[0] + X.shape[0], shape[1])
+
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                                  'fortran_order': False, 'shape': shape})
+    header = header.getvalue()
+    if len(header) != offset:
+        old = np.load(filename, mmap_mode='r')
+        out = np.lib.format.open_memmap(filename + '.tmp', mode='w+', dtype=dtype, shape=shape)
+        out[:old.shape[0]] = old
+        out[old.shape[0]:] = X
+        out.flush()
+        del old, out
+        os.replace(filename + '.tmp', filename)
+        return shape
+    with open(filename, 'r+b') as f:
+        f.write(header)
+        f.seek(0, 2)
+        X.tofile(f)
+    return shape
+
+
+def append_csv(X, filename, start, rows=1000):
+    """
+    Appending rows to csv file written by save_csv, numbers of rows begin from start.
+    """
+    with open(filename, 'a') as f:
+        for first in range(0, X.shape[0], rows):
+            block = np.asarray(X[first:first+rows])
+            np.savetxt(f, np.column_stack((np.arange(start+first, start+first+block.shape[0]), block)), fmt='%d',
+                       delimiter=',')
+
+
+def append_packed(filename, X, snps=4096):
+    """
+    Appending patients to packed genotype file. Patients are packed in bytes of every SNP, so the file is rewritten
+    in blocks of SNPs.
+    :param filename: (str) name of packed file
+    :param X: (ndarray) matrix new patients x SNPs
+    :param snps: (int) number of SNPs rewritten at once
+    :return: (int) new number of patients
+    """
+    packed, pat, snp = load_packed(filename)
+    if X.shape[1] != snp:
+        raise exceptions.WrongValueError('X', str(X.shape), 'Number of SNPs in %s is %d.' % (filename, snp))
+    save_packed(filename + '.tmp', pat + X.shape[0], snp,
+                (np.vstack((unpack_genotypes(packed, pat, cols=range(start, min(start+snps, snp))),
+                            X[:, start:start+snps])).T for start in range(0, snp, snps)))
+    del packed
+    os.replace(filename + '.tmp', filename)
+    return pat + X.shape[0]
+
+
 def load_data(ch, dataset, snpsubset, snpruns, testpat, trainpat):
     """
     Loading data from files into X and y matrices.
@@ -182,14 +355,10 @@ def load_data(ch, dataset, snpsubset, snpruns, testpat, trainpat):
             raise exceptions.NoParameterError('subset', 'There is more than one given data set, but subset of SNPs ' +
                                                         'is not given.')
         else:
-            cc = open('%smatrices/genome_stats.txt' % list(dataset.values())[0], 'r')
-            snp = None
-            for line in cc:
-                if line.startswith('%d\t' % ch):
-                    snp = int(line.split()[1])
-                    break
-            cc.close()
-            if 'snp' is None:
+            manifest = load_manifest(list(dataset.values())[0])
+            found = np.flatnonzero(manifest['chromosomes'] == str(ch))
+            snp = int(manifest['stats'][found[0], 0]) if len(found) else None
+            if snp is None:
                 raise exceptions.OtherError('There is no information about chromosome %d in %sgenome_stats.txt file'
                                             % (ch, list(dataset.values())[0]))
             snplist[next(iter(dataset.keys()))] = list(range(snp))
@@ -197,70 +366,277 @@ def load_data(ch, dataset, snpsubset, snpruns, testpat, trainpat):
     return read_Xs(ch, dataset, snp, snplist, testpat, trainpat)
 
 
-def read_Xs(ch, dataset, snp, snplist, testpat, trainpat):
+def csv_blocks(filename, cols, rows=4096):
+    """
+    Reading csv matrix (written by save_csv) in blocks of rows by C parser of pandas, only given columns are parsed.
+    :param cols: (list) numbers of SNPs (columns without the first one with numbers of rows), in the order of output
+    :return: generator of matrices rows x len(cols) (int8)
+    """
+    cols = np.asarray(cols, dtype=np.int64)
+    # parser gives columns in the order of the file
+    ucols, inverse = np.unique(cols, return_inverse=True)
+    usecols = (ucols + 1).tolist() if len(ucols) else [0]
+    for chunk in pd.read_csv(filename, usecols=usecols, dtype=np.int8, chunksize=rows):
+        if len(ucols):
+            yield chunk.values[:, inverse]
+        else:
+            yield np.zeros(shape=(len(chunk), 0), dtype=np.int8)
+
+
+def file_sha1(filename, size=2**20):
+
+    h = hashlib.sha1()
+    with open(filename, 'rb') as o:
+        for block in iter(lambda: o.read(size), b''):
+            h.update(block)
+    return h.hexdigest()
+
 
+def csv_cache(csvfile, rows=4096):
+    """
+    Binary cache of csv matrix: at first access the csv file is converted into {csvfile}.npy (with sha1 of the csv file
+    in {csvfile}.sha1), later the npy file is memory-mapped. Cache is made again if the csv file is newer and its content
+    has changed. Cache is written into temporary file and renamed, so processes running at once can share it.
+    :return: (str) name of npy file, None if it cannot be written
+    """
+    cache, hashfile = csvfile + '.npy', csvfile + '.sha1'
+    if os.path.isfile(cache) and os.path.isfile(hashfile):
+        if os.path.getmtime(cache) >= os.path.getmtime(csvfile):
+            return cache
+        digest = file_sha1(csvfile)
+        with open(hashfile, 'r') as h:
+            if h.read().strip() == digest:
+                os.utime(cache)
+                return cache
+    else:
+        digest = file_sha1(csvfile)
+
+    with open(csvfile, 'rb') as o:
+        snp = len(o.readline().split(b',')) - 1
+        pat, last = 0, b'\n'
+        for block in iter(lambda: o.read(2**20), b''):
+            pat += block.count(b'\n')
+            last = block[-1:]
+        pat += last != b'\n'  # the last line without end of line
+    tmp = '%s.%d.tmp' % (cache, os.getpid())
+    tmphash = '%s.%d.tmp' % (hashfile, os.getpid())
+    try:
+        X = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.int8, shape=(pat, snp))
+        start = 0
+        for block in csv_blocks(csvfile, range(snp), rows):
+            X[start:start+len(block)] = block
+            start += len(block)
+        if start != pat:
+            raise exceptions.OtherError('Wrong number of rows in %s!' % csvfile)
+        X.flush()
+        del X
+        # cache has to be in place before its hash, otherwise the hash could be matched with old cache
+        os.replace(tmp, cache)
+        with open(tmphash, 'w') as h:
+            h.write(digest + '\n')
+        os.replace(tmphash, hashfile)
+    except OSError:
+        return None
+    finally:
+        for file in [tmp, tmphash]:
+            if os.path.isfile(file):
+                os.remove(file)
+    return cache
+
+
+def read_Xs(ch, dataset, snp, snplist, testpat, trainpat, X_train=None, X_test=None):
+    """
+    Reading X matrices of train and test patients for one chromosome.
+    :param X_train: (ndarray) matrix (e.g. columns of genome-wide matrix) which should be filled instead of new one
+    :param X_test: (ndarray) the same for test patients
+    """
     train_row = 0
     test_row = 0
     done = 0
 
-    X_train = np.zeros(shape=(len(trainpat), snp), dtype=np.int8)
+    if X_train is None:
+        X_train = np.zeros(shape=(len(trainpat), snp), dtype=np.int8)
 
-    if testpat:
+    if testpat and X_test is None:
         X_test = np.zeros(shape=(len(testpat), snp), dtype=np.int8)
+    trainpat = np.fromiter(trainpat, dtype=np.int64)
+    testpat = np.fromiter(testpat, dtype=np.int64) if testpat else np.zeros(0, dtype=np.int64)
 
     for name in dataset.keys():
 
-        o = open('%smatrices/X_chr%d_nodif.csv' % (dataset[name], ch), 'r')
-        reader = csv.reader(o, delimiter=',')
-        next(reader)  # header
-
-        # writing values from file to matrix X
-
-        for i, line in enumerate(reader):
-            if (done + i) in trainpat:
-                for j, s in enumerate(snplist[name]):
-                    X_train[train_row][j] = line[s + 1]
-                train_row += 1
-            elif (done + i) in testpat:
-                for j, s in enumerate(snplist[name]):
-                    X_test[test_row][j] = line[s + 1]
-                test_row += 1
-
-        o.close()
-        done += i + 1
+        npyfile = '%smatrices/X_chr%d_nodif.npy' % (dataset[name], ch)
+        packedfile = '%smatrices/X_chr%d_nodif.gtp' % (dataset[name], ch)
+        csvfile = '%smatrices/X_chr%d_nodif.csv' % (dataset[name], ch)
+        if not os.path.isfile(npyfile) and not os.path.isfile(packedfile):
+            # csv matrix is read through its binary cache (if it can be written)
+            npyfile = csv_cache(csvfile) or npyfile
+        if os.path.isfile(npyfile) or os.path.isfile(packedfile):
+            # binary matrix - selection of rows and columns without parsing text
+            if os.path.isfile(npyfile):
+                x = np.load(npyfile, mmap_mode='r')
+                p = x.shape[0]
+            else:
+                x, p, _ = load_packed(packedfile)
+            blocks = [(x, p)]
+        else:
+            # csv matrix - whole blocks of rows are parsed, only columns of selected SNPs
+            x = None
+            blocks = ((block, len(block)) for block in csv_blocks(csvfile, snplist[name]))
+
+        for block, p in blocks:
+            # rows are routed into train and test matrices by boolean masks
+            rows = np.arange(done, done + p)
+            train = np.isin(rows, trainpat)
+            test = ~train & np.isin(rows, testpat)
+            for mask, X, row in [[train, X_train, train_row], [test, X_test if testpat.size else None, test_row]]:
+                if mask.any():
+                    sel = np.flatnonzero(mask)
+                    if block is not x:
+                        X[row:row+len(sel)] = block[sel]
+                    elif os.path.isfile(npyfile):
+                        X[row:row+len(sel)] = x[np.ix_(sel, snplist[name])]
+                    else:
+                        X[row:row+len(sel)] = unpack_genotypes(x, p, sel, snplist[name])
+            train_row += int(train.sum())
+            test_row += int(test.sum())
+            done += p
 
-    if testpat:
+    if testpat.size:
         return X_train, X_test, snp
     else:
         return X_train, None, snp
 
 
+def manifest_checksum(matrices):
+
+    h = hashlib.sha1()
+    for name in MANIFEST_SOURCES:
+        if os.path.isfile(matrices + name):
+            with open(matrices + name, 'rb') as o:
+                h.update(name.encode() + b'\0' + o.read() + b'\0')
+    return h.hexdigest()
+
+
+def build_manifest(matrices):
+    """
+    Making manifest of data set from its genome_stats.txt, Y_chr.csv and pid_chr.txt (if they exist): chromosomes with
+    numbers of SNPs and patients, numbers of rows and diagnoses from Y matrix, IDs of patients and checksum of the files.
+    :param matrices: (str) matrices directory of data set
+    :return: (dict) arrays of manifest
+    """
+    chromosomes, stats = [], []
+    with open('%sgenome_stats.txt' % matrices, 'r') as g:
+        for line in g:
+            line = line.split()
+            if line:
+                chromosomes.append(line[0])
+                stats.append(list(map(int, line[1:])))
+    if len(set(map(len, stats))) > 1:
+        raise exceptions.OtherError('Lines of %sgenome_stats.txt have different numbers of columns!' % matrices)
+    rows, diagnoses = [], []
+    if os.path.isfile('%sY_chr.csv' % matrices):
+        with open('%sY_chr.csv' % matrices, 'r') as y:
+            for line in y:
+                if line.strip():
+                    line = line.split(',')
+                    rows.append(int(line[0]))
+                    diagnoses.append(int(line[1]))
+    pids = []
+    if os.path.isfile('%spid_chr.txt' % matrices):
+        with open('%spid_chr.txt' % matrices, 'r') as o:
+            pids = [line.strip() for line in o if line.strip()]
+    manifest = {'chromosomes': np.array(chromosomes, dtype=str), 'stats': np.array(stats, dtype=np.int64),
+                'rows': np.array(rows, dtype=np.int64), 'diagnoses': np.array(diagnoses, dtype=np.int8),
+                'pids': np.array(pids, dtype=str), 'checksum': np.array(manifest_checksum(matrices))}
+    # manifest is written into temporary file and renamed, so other processes never read half-written file
+    tmp = '%s%s.%d.tmp' % (matrices, MANIFEST, os.getpid())
+    try:
+        with open(tmp, 'wb') as o:
+            np.savez(o, **manifest)
+        os.replace(tmp, matrices + MANIFEST)
+    except OSError:
+        if os.path.isfile(tmp):
+            os.remove(tmp)  # data set is read-only, manifest is kept only in memory
+    return manifest
+
+
+def load_manifest(directory):
+    """
+    Loading manifest of data set (once per process). Manifest is made at first use and again if genome_stats.txt,
+    Y_chr.csv or pid_chr.txt is newer and its content has changed.
+    :param directory: (str) directory of data set (with matrices directory)
+    :return: (dict) chromosomes (names), stats (columns of genome_stats.txt after the name: SNPs, patients, patients
+    with NL/AD diagnosis), rows and diagnoses (columns of Y_chr.csv), pids (IDs of patients), checksum
+    """
+    matrices = '%smatrices/' % directory
+    if matrices in _manifests:
+        return _manifests[matrices]
+    mfile = matrices + MANIFEST
+    manifest = None
+    if os.path.isfile(mfile):
+        with np.load(mfile) as m:
+            manifest = {key: m[key] for key in m.files}
+        newer = [name for name in MANIFEST_SOURCES if os.path.isfile(matrices + name) and
+                 os.path.getmtime(matrices + name) > os.path.getmtime(mfile)]
+        if newer:
+            if str(manifest['checksum']) != manifest_checksum(matrices):
+                manifest = None
+            else:
+                # files were only touched, manifest is marked as up to date, so they are not hashed again
+                try:
+                    os.utime(mfile)
+                except OSError:
+                    pass
+    if manifest is None:
+        manifest = build_manifest(matrices)
+    _manifests[matrices] = manifest
+    return manifest
+
+
+def selection_mask(patients, size):
+    """
+    Changing collection of numbers of patients into boolean mask.
+    :param patients: (iterable) numbers of patients, or boolean mask
+    :param size: (int) number of all patients
+    :return: (ndarray) boolean vector
+    """
+    if isinstance(patients, np.ndarray) and patients.dtype == bool:
+        return patients[:size]
+    mask = np.zeros(size, dtype=bool)
+    if patients:
+        patients = np.fromiter(patients, dtype=np.int64)
+        mask[patients[patients < size]] = True
+    return mask
+
+
 def patients(dataset):
 
     pat = {name: 0 for name in dataset.keys()}
     for name in dataset.keys():
-        g = open('%smatrices/genome_stats.txt' % dataset[name], 'r')
-        line = g.readline()
-        p = int(line.split()[3])
-        for line in g:
-            if int(line.split()[3]) != p:
-                raise exceptions.OtherError('Error: there is different number of patients for different chromosomes!')
-        pat[name] = p
-        g.close()
+        p = np.unique(load_manifest(dataset[name])['stats'][:, 2])
+        if len(p) != 1:
+            raise exceptions.OtherError('Error: there is different number of patients for different chromosomes!')
+        pat[name] = int(p[0])
     return pat
 
 
+def diagnoses(dataset, pat=None):
+    """
+    Diagnoses (values of Y matrices) of patients from all data sets, in the order of data sets.
+    :param pat: (dict) number of patients of every data set, all rows of Y matrices are taken if None
+    :return: (ndarray) vector of diagnoses
+    """
+    y = []
+    for name, directory in dataset.items():
+        d = load_manifest(directory)['diagnoses']
+        y.append(d if pat is None else d[:pat[name]])
+    return np.concatenate(y) if y else np.zeros(0, dtype=np.int8)
+
+
 def patients_diagnoses(dataset, patients):
-    case, control = [], []
-    done = 0
-    for name in dataset.keys():
-        with open('%smatrices/Y_chr.csv' % dataset[name], 'r') as file:
-            for i, line in enumerate(file):
-                if i in patients:
-                    line = list(map(int, line.split(',')))
-                    if line[1] == 0:
-                        control.append(done + line[0])
-                    else:
-                        case.append(done + line[0])
-        done += i
-    return case, control
+
+    y = diagnoses(dataset)
+    selected = np.flatnonzero(selection_mask(patients, len(y)))
+    case = selected[y[selected] != 0]
+    control = selected[y[selected] == 0]
+    return case.tolist(), control.tolist()
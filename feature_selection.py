@@ -12,11 +12,17 @@ import sys
 
 def feature_selection(X_path, y_path, outdir, iterations = 1, rank_cutoff = 1, chunk_size=10000):
 
-    with open(X_path, 'r') as f:
-        header = f.readline().strip().split(',')
-
-    # the 0th column are the row numbers
-    feature_ids = np.arange(len(header)-1)
+    if X_path.endswith('.npy'):
+        # binary matrix (output of vcf_to_matrix.py/makeX.py), columns are read from memory-mapped file
+        X_all = np.load(X_path, mmap_mode='r')
+        feature_ids = np.arange(X_all.shape[1])
+    else:
+        X_all = None
+        with open(X_path, 'r') as f:
+            header = f.readline().strip().split(',')
+
+        # the 0th column are the row numbers
+        feature_ids = np.arange(len(header)-1)
     num_chunks = max(1, round(len(feature_ids) / chunk_size))
 
     print("Number of chunks", num_chunks)
@@ -53,7 +59,14 @@ def feature_selection(X_path, y_path, outdir, iterations = 1, rank_cutoff = 1, c
                 now = datetime.now()
                 current_time = now.strftime("%H:%M:%S")
                 print("Start Time =", current_time)
-                X = pd.read_csv(X_path, usecols=randomlist).values
+                if X_all is not None:
+                    X = np.asarray(X_all[:, randomlist])
+                else:
+                    # feature j is SNP column j+1 (the 0th column are the row numbers), as in npy matrix;
+                    # parser gives columns in the order of the file, so they are put back in the order of randomlist
+                    cols = [i + 1 for i in randomlist]
+                    X = pd.read_csv(X_path, usecols=cols).values
+                    X = X[:, np.searchsorted(sorted(cols), cols)]
                 print("Reading done for iteration " , iteration, "run ", run)
                 now = datetime.now()
                 current_time = now.strftime("%H:%M:%S")
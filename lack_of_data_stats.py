@@ -4,13 +4,22 @@ import os
 import matplotlib.pyplot as plt
 import argparse
 import json
+import corporate_funcs as funcs
 
 
 def find_weak(ch, indir):
     print('chr {}'.format(ch))
-    x = np.genfromtxt(os.path.join(indir, 'matrices/X_chr{}_nodif.csv'.format(ch)), delimiter=',', skip_header=1,
-                      dtype=np.int32)
-    x = x[:, 1:]  # skip first column
+    npy_file = os.path.join(indir, 'matrices/X_chr{}_nodif.npy'.format(ch))
+    gtp_file = os.path.join(indir, 'matrices/X_chr{}_nodif.gtp'.format(ch))
+    if os.path.exists(npy_file):
+        x = np.load(npy_file)
+    elif os.path.exists(gtp_file):
+        packed, pat, _ = funcs.load_packed(gtp_file)
+        x = funcs.unpack_genotypes(packed, pat)
+    else:
+        x = np.genfromtxt(os.path.join(indir, 'matrices/X_chr{}_nodif.csv'.format(ch)), delimiter=',', skip_header=1,
+                          dtype=np.int32)
+        x = x[:, 1:]  # skip first column
     print('matrix loaded: {}'.format(x.shape))
     num_genes = x.shape[1]
     weak_ratio = np.apply_along_axis(lambda row: sum(row == -1), 0, x) / num_genes
@@ -1,54 +1,122 @@
 import numpy as np
-import pandas as pd
-import csv
+import os
 import sys
+import corporate_funcs as funcs
+import exceptions
 
 '''
 See readme.txt for input, output and possible options.
 '''
 
-
-def makeX(ch, indir, outdir):
-
-    matrix = np.load('%smatrix_chr%s.npy' % (indir, ch))
-    matrix = matrix[:, :, 1]
-    matrix = pd.DataFrame(matrix)
-    matrix.to_csv('%sX_chr%s.csv' % (outdir, ch))
-
-
-def makeX_nodif(ch, indir, outdir):
-
-    o = open('%sX_chr%s.csv' % (indir, ch), 'r')
-    reader = csv.reader(o, delimiter=',')
-
-    w = open('%sX_chr%s_nodif.csv' % (outdir, ch), 'w')
-    writer = csv.writer(w, delimiter=',')
-
-    r = open('%sdif_chr.txt' % indir, 'r')
-    dif = int(r.readline().strip().split()[2])
-
-    writer.writerow(next(reader))  # header
-
-    j = 0
-    for i, line in enumerate(reader):
-        if i == dif:
-            try:
-                dif = int(r.readline().strip().split('\t')[2])
-            except IndexError:
-                dif = 0
-        else:
-            line[0] = j
-            writer.writerow(line)
-            j += 1
-
-    o.close()
-    r.close()
-    w.close()
-    return 'Chromosome %s, number of lines written into X_chr%s_nodif.csv: %d' % (ch, ch, j)
+# number of SNPs rewritten at once in packed matrices
+BLOCK = 4096
+
+
+def makeX(ch, indir):
+
+    for xfile in ['%sX_chr%s.npy' % (indir, ch), '%sX_chr%s.gtp' % (indir, ch)]:
+        if os.path.isfile(xfile):
+            return xfile  # binary X matrix has already been written by vcf_to_matrix.py
+    # X_chr_nodif is written straight from memory-mapped matrix_chr (second allele), without intermediate X_chr
+    return '%smatrix_chr%s.npy' % (indir, ch)
+
+
+def nodif_mask(indir, pat):
+    """
+    Making boolean mask of patients who are written into X_chr_nodif matrix - patients from dif_chr.txt are rejected.
+    Number of patients is checked with Y_chr.csv (if it exists), rows of X_chr_nodif have to match it.
+    :param pat: (int) number of patients (rows) of X_chr matrix
+    :return: (ndarray) boolean vector, True for patients who are kept
+    """
+    dif = []
+    with open('%sdif_chr.txt' % indir, 'r') as r:
+        for line in r:
+            if line.strip():
+                dif.append(int(line.strip().split('\t')[2]))
+    yfile = '%sY_chr.csv' % indir
+    if os.path.isfile(yfile):
+        with open(yfile, 'r') as y:
+            rows = sum([1 for line in y if line.strip()])
+        if rows != pat:
+            raise exceptions.OtherError('Number of patients in %s (%d) is different than in X matrix (%d)!' %
+                                        (yfile, rows, pat))
+    keep = np.ones(pat, dtype=bool)
+    keep[dif] = False
+    return keep
+
+
+def write_rows(X, keep, filename, allele=None):
+    """
+    Writing selected rows of memory-mapped matrix into npy file in blocks of rows, so the whole matrix is never loaded.
+    :param X: (memmap) X_chr matrix (patients x SNPs) or matrix_chr (patients x SNPs x 2 alleles)
+    :param keep: (ndarray) boolean mask of rows which are written
+    :param allele: (int) number of allele written if X has values of both alleles
+    :return: (memmap) written matrix
+    """
+    rows = np.flatnonzero(keep)
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=X.dtype, shape=(len(rows), X.shape[1]))
+    step = max(1, BLOCK * BLOCK // max(1, X.shape[1]))
+    for start in range(0, len(rows), step):
+        block = X[rows[start:start+step]]
+        out[start:start+step] = block if allele is None else block[:, :, allele]
+    out.flush()
+    return out
+
+
+def makeX_nodif(ch, indir, outdir, xfile, csv=False, append=False):
+
+    nodif = '%sX_chr%s_nodif%s' % (outdir, ch, os.path.splitext(xfile)[1])
+    if append and os.path.isfile(nodif):
+        return makeX_nodif_append(ch, indir, outdir, xfile, nodif, csv)
+
+    if xfile.endswith('.gtp'):
+        # packed matrix stays packed, it is rewritten in blocks of SNPs
+        X, pat, snp = funcs.load_packed(xfile)
+        keep = np.flatnonzero(nodif_mask(indir, pat))
+        funcs.save_packed('%sX_chr%s_nodif.gtp' % (outdir, ch), len(keep), snp,
+                          (funcs.unpack_genotypes(X, pat, keep, range(start, min(start+BLOCK, snp))).T
+                           for start in range(0, snp, BLOCK)))
+        if csv:
+            funcs.save_csv(funcs.unpack_genotypes(X, pat, keep), '%sX_chr%s_nodif.csv' % (outdir, ch))
+        return 'Chromosome %s, number of lines written into X_chr%s_nodif.gtp: %d' % (ch, ch, len(keep))
+
+    # rows are selected from memory-mapped matrix by boolean mask, matrix_chr gives only the second allele
+    X = np.load(xfile, mmap_mode='r')
+    X = write_rows(X, nodif_mask(indir, X.shape[0]), '%sX_chr%s_nodif.npy' % (outdir, ch),
+                   1 if X.ndim == 3 else None)
+    if csv:
+        funcs.save_csv(X, '%sX_chr%s_nodif.csv' % (outdir, ch))
+
+    j = X.shape[0]
+    return 'Chromosome %s, number of lines written into X_chr%s_nodif.npy: %d' % (ch, ch, j)
+
+
+def makeX_nodif_append(ch, indir, outdir, xfile, nodif, csv=False):
+    """
+    Adding to existing X_chr_nodif matrix only patients appended to X_chr matrix (by vcf_to_matrix.py -append) -
+    rows of X_chr_nodif are the first selected patients, so selected patients after them are new.
+    """
+    if xfile.endswith('.gtp'):
+        X, pat, _ = funcs.load_packed(xfile)
+        _, old, _ = funcs.load_packed(nodif)
+        keep = np.flatnonzero(nodif_mask(indir, pat))
+        new = funcs.unpack_genotypes(X, pat, keep[old:])
+        funcs.append_packed(nodif, new)
+    else:
+        X = np.load(xfile, mmap_mode='r')
+        old = np.load(nodif, mmap_mode='r').shape[0]
+        keep = np.flatnonzero(nodif_mask(indir, X.shape[0]))
+        new = np.asarray(X[keep[old:]])
+        funcs.append_rows(nodif, new)
+    if csv and os.path.isfile(nodif[:-4] + '.csv'):
+        funcs.append_csv(new, nodif[:-4] + '.csv', old)
+    return 'Chromosome %s, number of lines appended to %s: %d' % (ch, os.path.basename(nodif), new.shape[0])
 
 
 ch = '1'
 indir = './'
+csv = False
+append = False
 for q in range(len(sys.argv)):
     if sys.argv[q] == '-chr':
         ch = sys.argv[q+1]
@@ -56,9 +124,13 @@ for q in range(len(sys.argv)):
         indir = sys.argv[q+1]
     if sys.argv[q] == '-outdir':
         outdir = sys.argv[q+1]
+    if sys.argv[q] == '-csv':
+        csv = True
+    if sys.argv[q] == '-append':
+        append = True
 
 if 'outdir' not in globals():
     outdir = indir
 
-makeX(ch, indir, outdir)
-print(makeX_nodif(ch, indir, outdir))
+xfile = makeX(ch, indir)
+print(makeX_nodif(ch, indir, outdir, xfile, csv, append))
@@ -9,7 +9,11 @@ See readme.txt for input, output and possible options.
 function make(){
 
 	echo "running makeX.py for chr $1"
-	python3 makeX.py -chr $1 -indir $2 -outdir $3
+	if [[ $4 -eq 1 ]]; then
+		python3 makeX.py -chr $1 -indir $2 -outdir $3 -csv
+	else
+		python3 makeX.py -chr $1 -indir $2 -outdir $3
+	fi
 	echo "X matrix for chr $1 done!"
 
 }
@@ -19,6 +23,7 @@ all=0
 from=1
 to=23
 dir='./'
+csv=0
 
 while [[ "$1" != "" ]]; do
         case $1 in
@@ -45,6 +50,8 @@ while [[ "$1" != "" ]]; do
         -outdir )               shift
                                 outdir=$1
                                 ;;
+        -csv )                  csv=1
+                                ;;
         *)                      usage
                                 exit 1
         esac
@@ -64,12 +71,12 @@ if [[ ${all} -eq 1 ]]; then
 
         for (( i=$from; i<=$to; i++ )); do                
 
-                job_pool_run make ${i} ${indir} ${outdir}
+                job_pool_run make ${i} ${indir} ${outdir} ${csv}
 
         done
 
         job_pool_shutdown
         echo "job_pool_nerrors: ${job_pool_nerrors}"
 else
-        make ${ch} ${indir} ${outdir}
+        make ${ch} ${indir} ${outdir} ${csv}
 fi
@@ -37,7 +37,7 @@ def makeY(indir, outdir):
 def update_genome_stats(indir, pat):
     """
     Writing in addition to genome_stats.txt number of patients with diagnosis NL or AD (who can be used for further
-    analysis)
+    analysis), the column written by previous run of makeY.py is replaced
     :param indir: input directory
     :param pat: number of patients with NL or AD diagnosis
     :return: None
@@ -48,7 +48,7 @@ def update_genome_stats(indir, pat):
     stats.close()
     stats = open('%sgenome_stats.txt' % indir, 'w')
     for line in lines:
-        stats.write(line.strip() + '\t%d\n' % pat)
+        stats.write('\t'.join(line.split()[:3]) + '\t%d\n' % pat)
     stats.close()
     return None
 
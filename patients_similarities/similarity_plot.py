@@ -6,6 +6,7 @@ import scipy.cluster.hierarchy as hc
 import scipy.spatial as sp
 sys.path.insert(0, '../')
 import exceptions
+import corporate_funcs as funcs
 
 
 def make_lists(set1, set2, dataset):
@@ -47,13 +48,8 @@ def check_group(dataset, group):
 
 def give_rows(datadir, value):
 
-    l = []
-    for line in open('%smatrices/Y_chr.csv' % datadir, 'r'):
-        line = line.strip().split(',')
-        v = int(line[1])
-        if v == value:
-            l.append(int(line[0]))
-    return l
+    manifest = funcs.load_manifest(datadir)
+    return manifest['rows'][manifest['diagnoses'] == value].tolist()
 
 
 def get_title(dataset, set1, set2):
@@ -174,10 +170,7 @@ for sets, name in [[seta, 'setA'], [setb, 'setB']]:
                     raise exceptions.WrongValueError('%s%d' % (name, i), el, 'There is no such data set as %s' % el[0])
 
 for d in dataset:
-    o = open('%smatrices/genome_stats.txt' % d[1], 'r')
-    line = o.readline()
-    pat = int(line.split()[3])
-    d.append(pat)
+    d.append(int(funcs.load_manifest(d[1])['stats'][0, 2]))
 
 for set1, set2 in zip(seta, setb):
     rows1, rows2 = make_lists(set1, set2, dataset)
@@ -0,0 +1,344 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import hashlib
+import os
+import subprocess
+import sys
+import time
+import exceptions
+
+'''
+See readme.txt for input, output and possible options.
+Driver of preprocessing (instead of prepreparing.sh, make_pid-diagnoses.py, makeY.py and makeX_pooling.sh run one
+after another): steps are modeled as a graph of dependencies and run only if their outputs are older than inputs.
+'''
+
+# fraction of available memory which can be used by running steps
+MEMORY_FRACTION = 0.8
+
+
+class Step(object):
+    """
+    One step of preprocessing - commands run one after another, e.g. one python script for one chromosome.
+    :param name: (str) unique name of the step
+    :param inputs: (list) files needed by the step
+    :param outputs: (list) files made by the step
+    :param commands: (list) commands (lists of arguments) or python functions without arguments
+    :param deps: (list) names of steps which have to be done before this step
+    :param stdout: (str) file into which standard output of commands is written, if given
+    :param restat: (list) outputs which are often rewritten with the same content - if their content has not changed,
+    their old modification time is restored, so steps depending on them are not run again
+    :param cores: (int) number of cores used by the step
+    :param memory: (int) estimated memory used by the step (bytes)
+    """
+
+    def __init__(self, name, inputs, outputs, commands, deps=(), stdout=None, restat=(), cores=1, memory=0):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.commands = commands
+        self.deps = list(deps)
+        self.stdout = stdout
+        self.restat = list(restat)
+        self.cores = cores
+        self.memory = memory
+        self.status = 'waiting'
+        self.time = 0.
+        self.error = ''
+
+    def outdated(self):
+        """
+        Checking if the step has to be run: some output does not exist or is older than some input.
+        """
+        for file in self.inputs:
+            if not os.path.isfile(file):
+                raise exceptions.NoFileError('%s (needed by step %s)' % (file, self.name))
+        if not all([os.path.isfile(file) for file in self.outputs]):
+            return True
+        if not self.inputs:
+            return False
+        return min([os.path.getmtime(file) for file in self.outputs]) < \
+            max([os.path.getmtime(file) for file in self.inputs])
+
+
+def file_hash(file):
+    h = hashlib.md5()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.digest()
+
+
+def run_step(step):
+    """
+    Running commands of the step (function for the pool of workers). Outputs of failed step are removed, so the step
+    is run again next time.
+    :return: (tuple) step, if the step succeeded
+    """
+    old = {}
+    for file in step.restat:
+        if os.path.isfile(file):
+            old[file] = (file_hash(file), os.stat(file))
+
+    start = time.time()
+    ok = True
+    out = b''
+    for command in step.commands:
+        if callable(command):
+            try:
+                command()
+            except Exception as e:
+                step.error = repr(e)
+                ok = False
+                break
+            continue
+        p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out += p.stdout
+        if p.returncode != 0:
+            step.error = p.stderr.decode(errors='replace').strip().split('\n')[-1]
+            ok = False
+            break
+    step.time = time.time() - start
+
+    if not ok:
+        for file in step.outputs:
+            if os.path.isfile(file) and os.path.getmtime(file) >= start:
+                os.remove(file)
+        return step, False
+
+    if step.stdout is not None:
+        with open(step.stdout, 'wb') as f:
+            f.write(out)
+    for file, (h, st) in old.items():
+        if os.path.isfile(file) and file_hash(file) == h:
+            os.utime(file, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return step, True
+
+
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return 0
+
+
+def run_pipeline(steps, cores, memory):
+    """
+    Running steps in the order of dependencies. Step is started when all steps it depends on are done and there are
+    enough free cores and memory (steps which need more than the whole memory are run alone).
+    :param steps: (list) steps of the pipeline
+    :param cores: (int) number of cores which can be used at once
+    :param memory: (int) memory (bytes) which can be used at once
+    :return: (int) number of failed steps
+    """
+    steps = {step.name: step for step in steps}
+    for step in steps.values():
+        for dep in step.deps:
+            if dep not in steps:
+                raise exceptions.OtherError('Step %s depends on unknown step %s!' % (step.name, dep))
+
+    running = {}
+    used_cores = 0
+    used_memory = 0
+    pool = ThreadPoolExecutor(max_workers=max(cores, 1))
+    while True:
+        changed = False
+        for step in steps.values():
+            if step.status != 'waiting':
+                continue
+            deps = [steps[dep].status for dep in step.deps]
+            if any([status in ['failed', 'not run'] for status in deps]):
+                step.status = 'not run'
+                changed = True
+                continue
+            if not all([status in ['done', 'up to date'] for status in deps]):
+                continue
+            if not step.outdated():
+                step.status = 'up to date'
+                changed = True
+                continue
+            if running and (used_cores + step.cores > cores or used_memory + step.memory > memory):
+                continue
+            print('%s started' % step.name)
+            step.status = 'running'
+            used_cores += step.cores
+            used_memory += step.memory
+            running[pool.submit(run_step, step)] = step
+
+        if not running:
+            if changed:
+                # some steps were up to date (or cannot be run), steps depending on them can be checked now
+                continue
+            if any([step.status == 'waiting' for step in steps.values()]):
+                raise exceptions.OtherError('There is a cycle in dependencies of steps!')
+            break
+
+        finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+        for future in finished:
+            step = running.pop(future)
+            used_cores -= step.cores
+            used_memory -= step.memory
+            step, ok = future.result()
+            if ok:
+                step.status = 'done'
+                print('%s done in %.1f s' % (step.name, step.time))
+            else:
+                step.status = 'failed'
+                print('%s failed after %.1f s: %s' % (step.name, step.time, step.error))
+    pool.shutdown()
+
+    print('\nStep\tStatus\tTime [s]')
+    for step in steps.values():
+        print('%s\t%s\t%.1f' % (step.name, step.status, step.time))
+    return len([step for step in steps.values() if step.status == 'failed'])
+
+
+def find_vcf(indir, vcfname):
+    """
+    Finding vcf file for the chromosome - uncompressed or compressed (read directly by vcf_to_matrix.py).
+    """
+    for end in ['', '.gz', '.tar.gz', '.tar']:
+        if os.path.isfile(indir + vcfname + end):
+            return indir + vcfname + end
+    raise exceptions.NoFileError(vcfname)
+
+
+def join_genome_stats(outdir, chromosomes):
+    """
+    Writing genome_stats.txt from lines written by vcf_to_matrix.py for every chromosome (sorted by chromosome).
+    """
+    with open('%sgenome_stats.txt' % outdir, 'w') as g:
+        for ch in chromosomes:
+            with open('%sgenome_stats_chr%s.txt' % (outdir, ch), 'r') as s:
+                g.write(s.read())
+
+
+def make_steps(chromosomes, vcffiles, indir, outdir, diagdir, dataset, options):
+    """
+    Making graph of steps of preprocessing:
+    - matrix_chr{chr} - vcf_to_matrix.py for every chromosome,
+    - diagnoses - make_pid-diagnoses.py,
+    - Y - genome_stats.txt and makeY.py,
+    - X_chr{chr} - makeX.py for every chromosome.
+    :return: (list) steps
+    """
+    python = sys.executable
+    here = os.path.dirname(os.path.abspath(__file__))
+    xend = '.gtp' if options['packed'] else '.npy'
+
+    steps = []
+    for ch, vcf in zip(chromosomes, vcffiles):
+        command = [python, os.path.join(here, 'vcf_to_matrix.py'), '-chr', ch, '-input', vcf, '-outdir', outdir,
+                   '-threads', str(options['threads']), '-procs', str(options['procs'])]
+        for flag in ['stats', 'snps_only', 'packed']:
+            if options[flag]:
+                command.append('-' + flag)
+        for flag in ['min_gq', 'min_dp', 'keep', 'diagnoses', 'min_maf', 'max_missing']:
+            if options[flag] is not None:
+                command += ['-' + flag, str(options[flag])]
+        # genotypes of one patient take about 4 bytes of vcf file, compressed files are ~10 times smaller
+        memory = os.path.getsize(vcf) // 4 * (10 if vcf.endswith('gz') else 1)
+        # changed lists of patients make the matrices stale
+        patients = [options[flag] for flag in ['keep', 'diagnoses'] if options[flag] is not None]
+        steps.append(Step('matrix_chr%s' % ch, [vcf] + patients,
+                          ['%sX_chr%s%s' % (outdir, ch, xend), '%ssnps_chr%s.txt' % (outdir, ch),
+                           '%spid_chr%s.txt' % (outdir, ch), '%sgenome_stats_chr%s.txt' % (outdir, ch)],
+                          [command], stdout='%sgenome_stats_chr%s.txt' % (outdir, ch),
+                          restat=['%spid_chr%s.txt' % (outdir, ch)], cores=options['procs'], memory=memory))
+
+    if dataset is None:
+        return steps
+
+    steps.append(Step('diagnoses', ['%spid_chr%s.txt' % (outdir, ch) for ch in chromosomes] +
+                      [diagdir + el for el in sorted(os.listdir(diagdir)) if os.path.isfile(diagdir + el)],
+                      ['%spid_chr.txt' % outdir, '%sdiagnoses.txt' % outdir],
+                      [[python, os.path.join(here, 'make_pid-diagnoses.py'), '-indir', outdir, '-outdir', outdir,
+                        '-diagdir', diagdir, '-dataset', dataset]],
+                      deps=['matrix_chr%s' % ch for ch in chromosomes],
+                      restat=['%spid_chr.txt' % outdir, '%sdiagnoses.txt' % outdir]))
+
+    steps.append(Step('Y', ['%spid_chr.txt' % outdir, '%sdiagnoses.txt' % outdir] +
+                      ['%sgenome_stats_chr%s.txt' % (outdir, ch) for ch in chromosomes],
+                      ['%sY_chr.csv' % outdir, '%sdif_chr.txt' % outdir, '%sgenome_stats.txt' % outdir],
+                      [lambda: join_genome_stats(outdir, chromosomes),
+                       [python, os.path.join(here, 'makeY.py'), '-indir', outdir, '-outdir', outdir]],
+                      deps=['diagnoses'], restat=['%sY_chr.csv' % outdir, '%sdif_chr.txt' % outdir]))
+
+    for ch in chromosomes:
+        command = [python, os.path.join(here, 'makeX.py'), '-chr', ch, '-indir', outdir, '-outdir', outdir]
+        if options['csv']:
+            command.append('-csv')
+        xfile = '%sX_chr%s%s' % (outdir, ch, xend)
+        steps.append(Step('X_chr%s' % ch, [xfile, '%sdif_chr.txt' % outdir],
+                          ['%sX_chr%s_nodif%s' % (outdir, ch, xend)], [command],
+                          deps=['matrix_chr%s' % ch, 'Y'],
+                          memory=2 * (os.path.getsize(xfile) if os.path.isfile(xfile) else 0)))
+    return steps
+
+
+dir = './'
+chromosomes = None
+start = 1
+end = 23
+x = False
+vcf = 'default_chr.vcf'
+dataset = None
+cores = os.cpu_count()
+memory = None
+options = {'stats': False, 'snps_only': False, 'packed': False, 'csv': False, 'threads': 1, 'procs': 1,
+           'min_gq': None, 'min_dp': None, 'keep': None, 'diagnoses': None, 'min_maf': None, 'max_missing': None}
+for q in range(len(sys.argv)):
+    if sys.argv[q] == '-dir':
+        dir = sys.argv[q+1]
+    if sys.argv[q] == '-indir':
+        indir = sys.argv[q+1]
+    if sys.argv[q] == '-outdir':
+        outdir = sys.argv[q+1]
+    if sys.argv[q] == '-diagdir':
+        diagdir = sys.argv[q+1]
+    if sys.argv[q] == '-chr':
+        chromosomes = [sys.argv[q+1]]
+    if sys.argv[q] == '-from':
+        start = int(sys.argv[q+1])
+    if sys.argv[q] == '-to':
+        end = int(sys.argv[q+1])
+    if sys.argv[q] == '-x':
+        x = True
+    if sys.argv[q] == '-vcf':
+        vcf = sys.argv[q+1]
+    if sys.argv[q] == '-dataset':
+        dataset = sys.argv[q+1]
+    if sys.argv[q] == '-cores':
+        cores = int(sys.argv[q+1])
+    if sys.argv[q] == '-memory':
+        memory = int(float(sys.argv[q+1]) * 2**30)
+    if sys.argv[q] in ['-stats', '-packed', '-csv']:
+        options[sys.argv[q][1:]] = True
+    if sys.argv[q] == '-snp':
+        options['snps_only'] = True
+    if sys.argv[q] in ['-threads', '-procs', '-min_gq', '-min_dp']:
+        options[sys.argv[q][1:]] = int(sys.argv[q+1])
+    if sys.argv[q] in ['-keep', '-diagnoses']:
+        options[sys.argv[q][1:]] = sys.argv[q+1]
+    if sys.argv[q] in ['-min_maf', '-max_missing']:
+        options[sys.argv[q][1:]] = float(sys.argv[q+1])
+
+if 'indir' not in globals():
+    indir = '%sfiles/' % dir
+if 'outdir' not in globals():
+    outdir = '%smatrices/' % dir
+if 'diagdir' not in globals():
+    diagdir = '%sfiles/' % dir
+if not os.path.isdir(outdir):
+    os.makedirs(outdir)
+if memory is None:
+    memory = int(available_memory() * MEMORY_FRACTION)
+
+if chromosomes is None:
+    chromosomes = [str(ch) for ch in range(start, end+1)]
+vcfstart, vcfend = vcf.split('chr', 1)
+vcffiles = [find_vcf(indir, '%schr%s%s' % (vcfstart, 'X' if (ch == '23' and x) else ch, vcfend))
+            for ch in chromosomes]
+
+steps = make_steps(chromosomes, vcffiles, indir, outdir, diagdir, dataset, options)
+if run_pipeline(steps, cores, memory):
+    sys.exit(1)
@@ -9,6 +9,7 @@ SNP_ID  REF_BASE
 '
 
 binary=0
+bed=0
 step1=0
 step2=0
 sort=0
@@ -28,6 +29,8 @@ while [[ "$1" != "" ]]; do
                                 ;;
         -binary )               binary=1
                                 ;;
+        -bed )                  bed=1
+                                ;;
         -step1 )                step1=1
                                 ;;
         -step2 )                step2=1
@@ -68,7 +71,8 @@ if [[ ${binary} -eq 1 ]]; then
     echo "Convertion of binary plink files into text format done!"
 fi
 
-# sort SNPs in dbsnp and in map file
+# sort SNPs in dbsnp and in map file (not needed by step one, which reads dbsnp through its binary index
+# {dbsnp}.ids.npy and {dbsnp}.ref.npy made at the first use)
 if [[ ${sort} -eq 1 ]]; then
     echo "Sorting has just began!"
     export LC_ALL=C
@@ -76,27 +80,41 @@ if [[ ${sort} -eq 1 ]]; then
         echo "Sorting dbsnp!"
         sort -k1 ${dbsnp} >${dbsnp/./_ascii.}
     fi
-    echo "Sorting map file!"
-    sort -k2 ${indir}${plink}".map" >${indir}${plink}"_ascii.map"
+    if [[ ${bed} -eq 1 ]]; then
+        echo "Sorting bim file!"
+        sort -k2 ${indir}${plink}".bim" >${indir}${plink}"_ascii.map"
+    else
+        echo "Sorting map file!"
+        sort -k2 ${indir}${plink}".map" >${indir}${plink}"_ascii.map"
+    fi
     echo "File(s) were sorted successfully!"
 fi
 
 # compare SNPs with reference, make pid_chr.txt and genome_stats.txt, filter plink files
 if [[ ${step1} -eq 1 ]]; then
     echo "Step one has just began!"
-    python3 plink_step_one.py -indir ${indir} -outdir ${outdir} -plink ${plink} -dbsnp ${dbsnp}
-    echo "Step one done!"
-    ${plinkdir}plink --file ${indir}${plink} --exclude ${outdir}"missing_snps_ref.txt" --recode --out ${indir}${plink}"_filtered"
+    if [[ ${bed} -eq 1 ]]; then
+        python3 plink_step_one.py -indir ${indir} -outdir ${outdir} -plink ${plink} -dbsnp ${dbsnp} -bed
+        echo "Step one done!"
+        ${plinkdir}plink --bfile ${indir}${plink} --exclude ${outdir}"missing_snps_ref.txt" --make-bed --out ${indir}${plink}"_filtered"
+    else
+        python3 plink_step_one.py -indir ${indir} -outdir ${outdir} -plink ${plink} -dbsnp ${dbsnp}
+        echo "Step one done!"
+        ${plinkdir}plink --file ${indir}${plink} --exclude ${outdir}"missing_snps_ref.txt" --recode --out ${indir}${plink}"_filtered"
+    fi
     echo "SNPs were excluded, filtered plink files have been made."
 fi
 
 # make files with matrices and snps lists
 if [[ ${step2} -eq 1 ]]; then
     echo "Step two has just began!"
+    options=""
     if [[ ${overwrite} -eq 1 ]]; then
-        python3 plink_step_two.py -indir ${indir} -outdir ${outdir} -plink ${plink}"_filtered" -overwrite
-    else
-        python3 plink_step_two.py -indir ${indir} -outdir ${outdir} -plink ${plink}"_filtered"
+        options=${options}" -overwrite"
+    fi
+    if [[ ${bed} -eq 1 ]]; then
+        options=${options}" -bed"
     fi
+    python3 plink_step_two.py -indir ${indir} -outdir ${outdir} -plink ${plink}"_filtered"${options}
     echo "Step two done!"
 fi
\ No newline at end of file
@@ -1,12 +1,14 @@
+import numpy as np
+import os
 import sys
 sys.path.insert(0, '../')
 import exceptions
 
 '''
 Input:
-- map_ascii file
-- dbsnp_ascii.txt
-- ped file
+- map file (or bim file with -bed)
+- dbsnp.txt (or its index dbsnp.txt.ids.npy and dbsnp.txt.ref.npy made at the first use)
+- ped file (or fam file with -bed)
 
 Output:
 - snps_ref.txt
@@ -17,42 +19,98 @@ Output:
 '''
 
 
-def make_ref(dbsnp, plink, indir, outdir):
-
-    dbsnp = open('_ascii.'.join(dbsnp.split('.')), 'r')
-
-    mapfile = open('%s%s_ascii.map' % (indir, plink), 'r')
+def index_files(dbsnp):
+    return dbsnp + '.ids.npy', dbsnp + '.ref.npy'
+
+
+def build_ref_index(dbsnp, lines=1000000):
+    """
+    Converting dbsnp file (SNP ID and reference base in every line, in any order) into binary index: sorted SNP IDs
+    and their reference bases in two npy files next to the dbsnp file (index_files). If ID is in the file many times,
+    the first line is used.
+    """
+    ids, refs = [], []
+    chunk_ids, chunk_refs = [], []
+    with open(dbsnp, 'rb') as o:
+        for line in o:
+            line = line.split()
+            if not line:
+                continue
+            chunk_ids.append(line[0])
+            chunk_refs.append(line[1])
+            if len(chunk_ids) == lines:
+                ids.append(np.array(chunk_ids))
+                refs.append(np.array(chunk_refs))
+                chunk_ids, chunk_refs = [], []
+    ids.append(np.array(chunk_ids, dtype=bytes))
+    refs.append(np.array(chunk_refs, dtype=bytes))
+    # common width of all chunks, so that chunks can be joined
+    width = max([chunk.itemsize for chunk in ids])
+    ids = np.concatenate([chunk.astype('S%d' % width) for chunk in ids])
+    width = max([chunk.itemsize for chunk in refs])
+    refs = np.concatenate([chunk.astype('S%d' % width) for chunk in refs])
+    order = np.argsort(ids, kind='stable')
+    idsfile, reffile = index_files(dbsnp)
+    np.save(idsfile, ids[order])
+    np.save(reffile, refs[order])
+
+
+def load_ref_index(dbsnp):
+    """
+    Loading binary index of dbsnp file (memory-mapped), the index is made at first use and again if dbsnp file is newer.
+    :return: (tuple) sorted SNP IDs, reference bases
+    """
+    idsfile, reffile = index_files(dbsnp)
+    if not os.path.isfile(idsfile) or not os.path.isfile(reffile) or \
+            (os.path.isfile(dbsnp) and os.path.getmtime(dbsnp) > min(os.path.getmtime(idsfile),
+                                                                      os.path.getmtime(reffile))):
+        if not os.path.isfile(dbsnp):
+            raise exceptions.NoFileError(dbsnp)
+        build_ref_index(dbsnp)
+
+    return np.load(idsfile, mmap_mode='r'), np.load(reffile, mmap_mode='r')
+
+
+def make_ref(dbsnp, plink, indir, outdir, ext='map'):
+
+    ids, refs = load_ref_index(dbsnp)
+
+    chs, snps_ids = [], []
+    with open('%s%s.%s' % (indir, plink, ext), 'r') as mapfile:
+        for line in mapfile:
+            line = line.split()[:2]
+            if line:
+                chs.append(line[0])
+                snps_ids.append(line[1])
+
+    # SNPs are written in the order of their IDs, as in sorted map file
+    order = sorted(range(len(snps_ids)), key=lambda i: snps_ids[i].encode())
+    keys = np.array([snps_ids[i].encode() for i in order], dtype=bytes)
+    pos = np.searchsorted(ids, keys)
+    found = pos < len(ids)
+    found[found] = ids[pos[found]] == keys[found]
+    values = refs[pos[found]]
 
     ref = open('%ssnps_ref.txt' % outdir, 'w')
     missing = open('%smissing_snps_ref.txt' % outdir, 'w')
-
     snps = {}
-
-    snp = mapfile.readline().split()[:2]
-
-    for line in dbsnp:
-        if not snp:
-            break
-        line = line.split()
-        while line[0] > snp[1] and snp:
-            missing.write('%s\n' % snp[1])
-            snp = mapfile.readline().split()[:2]
-        if line[0] == snp[1]:
-            ref.write('%s\t%s\t%s\n' % (snp[0], snp[1], line[1]))
-            snps[snp[0]] = snps.setdefault(snp[0], 0) + 1
-            snp = mapfile.readline().split()[:2]
-
-    dbsnp.close()
-    mapfile.close()
+    k = 0
+    for i, f in zip(order, found):
+        if f:
+            ref.write('%s\t%s\t%s\n' % (chs[i], snps_ids[i], values[k].decode()))
+            snps[chs[i]] = snps.setdefault(chs[i], 0) + 1
+            k += 1
+        else:
+            missing.write('%s\n' % snps_ids[i])
     ref.close()
     missing.close()
 
     return snps
 
 
-def make_pid(plink, indir, outdir):
+def make_pid(plink, indir, outdir, ext='ped'):
 
-    pedfile = open('%s%s.ped' % (indir, plink), 'r')
+    pedfile = open('%s%s.%s' % (indir, plink, ext), 'r')
     o = open('%spid_chr.txt' % outdir, 'w')
     pat = 0
     for line in pedfile:
@@ -76,6 +134,7 @@ def genome_stats(pat, snps, outdir):
 
 
 indir = './'
+bed = False
 for q in range(len(sys.argv)):
     if sys.argv[q] == '-dbsnp':
         dbsnp = sys.argv[q+1]
@@ -85,6 +144,8 @@ for q in range(len(sys.argv)):
         indir = sys.argv[q+1]
     if sys.argv[q] == '-outdir':
         outdir = sys.argv[q+1]
+    if sys.argv[q] == '-bed':
+        bed = True
 
 if 'outdir' not in globals():
     outdir = indir
@@ -94,6 +155,6 @@ if 'plink' not in globals():
 if 'dbsnp' not in globals():
     raise exceptions.NoParameterError('dbsnp', 'name of file with list of SNPs assigned to their reference values')
 
-pat = make_pid(plink, indir, outdir)
-snps = make_ref(dbsnp, plink, indir, outdir)
+pat = make_pid(plink, indir, outdir, 'fam' if bed else 'ped')
+snps = make_ref(dbsnp, plink, indir, outdir, 'bim' if bed else 'map')
 genome_stats(pat, snps, outdir)
@@ -1,6 +1,7 @@
 import sys
 import numpy as np
 import os
+import tempfile
 sys.path.insert(0, '../')
 import exceptions
 
@@ -9,6 +10,7 @@ import exceptions
 Input:
 - {plink}.map
 - {plink}.ped
+(or {plink}.bim, {plink}.bed with -bed)
 - snps_ref.txt
 - genome_stats.txt
 
@@ -18,6 +20,22 @@ Output:
 
 '''
 
+# codes of alleles in ped file, other values are wrong
+BASES = 'ACGT0'
+CODES = np.full(256, len(BASES), dtype=np.uint8)
+for i, base in enumerate(BASES):
+    CODES[ord(base)] = i
+# number of alleles in one block of patients, temporary int64 arrays of a block take 8 times more bytes
+BLOCK = 2**24
+
+
+def block_rows(alleles):
+    """
+    Number of patients in one block, so that the block has about BLOCK alleles whatever the number of SNPs.
+    :param alleles: (int) number of alleles of one patient (2*SNPs)
+    """
+    return max(1, BLOCK // max(1, alleles))
+
 
 def make_snps_ref(outdir):
 
@@ -33,29 +51,56 @@ def make_snps_ref(outdir):
     return snps_ref
 
 
-def make_snps_count(plink, indir):
+def make_snps_count(alleles, rows=None):
+    """
+    Counting bases of every SNP (missing and wrong alleles are not counted).
+    :param alleles: (ndarray) matrix patients x 2*SNPs with alleles as bytes, from read_ped
+    :param rows: (int) number of patients in one block, by default sized from the number of SNPs
+    :return: (list) dictionaries base: count for every SNP
+    """
+    rows = rows or block_rows(alleles.shape[1])
+    counts = np.zeros(shape=(alleles.shape[1]//2, len(BASES)+1), dtype=np.int64)
+    for p in range(0, alleles.shape[0], rows):
+        codes = CODES[alleles[p:p+rows]].reshape(-1, counts.shape[0], 2)
+        # every SNP gets its own range of bins: SNP j, base b -> j*6+b
+        bins = codes + (np.arange(counts.shape[0]) * counts.shape[1])[np.newaxis, :, np.newaxis]
+        counts += np.bincount(bins.ravel(), minlength=counts.size).reshape(counts.shape)
+    # the same order of bases as before, order of bases with the same counts depends on it
+    counts = counts[:, [BASES.index(base) for base in 'ACTG']].tolist()
+
+    return [dict(zip('ACTG', c)) for c in counts]
 
-    pedfile = open('%s%s.ped' % (indir, plink), 'r')
-    snps_count = [{'A': 0, 'C': 0, 'T': 0, 'G': 0} for _ in range(len(pedfile.readline().split()[6:])//2)]
-    pedfile.seek(0, 0)
-    for i, line in enumerate(pedfile):
-        line = line.split()[6:]
-        for j, a, aa in zip(list(range(len(line)//2)), line[0::2], line[1::2]):
-            if a != '0':
-                snps_count[j][a] += 1
-            if aa != '0':
-                snps_count[j][aa] += 1
-    pedfile.close()
+
+def make_snps_count_bed(bed, bim, pat, snps=4096):
+    """
+    Counting bases of every SNP from genotypes of bed file (A1 twice for 00, A1 and A2 for 10, A2 twice for 11).
+    :param bed: (memmap) bytes of bed file, from read_bed
+    :param bim: (list) alleles A1 and A2 of every SNP, from read_bim
+    :return: (list) dictionaries base: count for every SNP
+    """
+    genotypes = np.zeros(shape=(bed.shape[0], 4), dtype=np.int64)
+    for s in range(0, bed.shape[0], snps):
+        codes = bed_codes(bed[s:s+snps], pat)
+        bins = codes + (np.arange(len(codes)) * 4)[:, np.newaxis]
+        genotypes[s:s+snps] = np.bincount(bins.ravel(), minlength=4*len(codes)).reshape(-1, 4)
+    first = (2*genotypes[:, 0] + genotypes[:, 2]).tolist()
+    second = (2*genotypes[:, 3] + genotypes[:, 2]).tolist()
+    snps_count = []
+    for (a1, a2), n1, n2 in zip(bim, first, second):
+        count = {'A': 0, 'C': 0, 'T': 0, 'G': 0}
+        for a, n in [(a1, n1), (a2, n2)]:
+            if a in count:
+                count[a] += n
+        snps_count.append(count)
 
     return snps_count
 
 
-def write_snps_list(plink, indir, outdir, overwrite):
+def write_snps_list(mapname, outdir, overwrite, snps_count):
 
     snps_ref = make_snps_ref(outdir)
-    snps_count = make_snps_count(plink, indir)
 
-    mapfile = open('%s%s.map' % (indir, plink), 'r')
+    mapfile = open(mapname, 'r')
     prevch = mapfile.readline()[0]
     mapfile.seek(0, 0)
     filename = '%ssnps_chr%s.txt' % (outdir, prevch)
@@ -92,50 +137,197 @@ def write_snps_list(plink, indir, outdir, overwrite):
     return snps_val
 
 
-def write_matrix(plink, indir, outdir, snps_val):
+def wrong_value(chs, snp, pat, a, aa):
+    """
+    Making PlinkWrongValue error for SNP given by its number in the whole ped file.
+    :param chs: (list) chromosomes with numbers of their first and last+1 SNP
+    """
+    ch, first, _ = [chi for chi in chs if chi[1] <= snp < chi[2]][0]
+    return exceptions.PlinkWrongValue('%d+%d' % (2*first, snp - first), ch, pat, a, aa)
+
+
+def ped_blocks(plink, indir, chs, rows=None):
+    """
+    Reading ped file in blocks of rows.
+    :param chs: (list) chromosomes with numbers of their first and last+1 SNP (for errors)
+    :param rows: (int) number of patients in one block, by default sized from the number of SNPs
+    :return: generator of matrices patients x 2*SNPs with alleles as bytes (uint8), CODES[block] gives codes of alleles
+    (A, C, G, T, 0 - 0, 1, 2, 3, 4, other - 5)
+    """
+    rows = rows or block_rows(2*chs[-1][2])
+    pedfile = open('%s%s.ped' % (indir, plink), 'rb')
+    block = []
+    for p, line in enumerate(pedfile):
+        # alleles have to be single characters, then they can be joined into one byte string
+        alleles = line.split()[6:]
+        row = b''.join(alleles)
+        if len(row) != len(alleles):
+            j = [len(a) > 1 for a in alleles].index(True) // 2
+            if j < chs[-1][2]:
+                raise wrong_value(chs, j, p, alleles[2*j].decode(), alleles[2*j+1].decode())
+        block.append(row)
+        if len(block) == rows:
+            yield join_ped(block)
+            block = []
+    if block:
+        yield join_ped(block)
+    pedfile.close()
 
-    stats = open('%sgenome_stats.txt' % outdir, 'r')
-    pedfile = open('%s%s.ped' % (indir, plink), 'r')
 
+def join_ped(block):
+
+    if len(set(map(len, block))) != 1:
+        raise exceptions.OtherError('Rows of ped file have different numbers of alleles!')
+    return np.frombuffer(b''.join(block), dtype=np.uint8).reshape(len(block), -1)
+
+
+def read_ped(plink, indir, outdir):
+    """
+    Reading alleles of all patients from ped file into temporary file in outdir, the ped file is read only once,
+    alleles are used for counting bases and building of matrices.
+    :return: (memmap) matrix patients x 2*SNPs with alleles as bytes (uint8)
+    """
+    stats = np.loadtxt('%sgenome_stats.txt' % outdir, dtype=np.int64, ndmin=2)
+    pat, snp = stats[0, 2], stats[:, 1].sum()
+    last = np.cumsum(stats[:, 1])
+    chs = [(str(ch), l - s, l) for ch, s, l in zip(stats[:, 0], stats[:, 1], last)]
+    alleles = np.memmap(tempfile.TemporaryFile(dir=outdir), dtype=np.uint8, mode='w+', shape=(pat, 2*snp))
+    p = 0
+    for block in ped_blocks(plink, indir, chs):
+        if block.shape[1] != alleles.shape[1]:
+            raise exceptions.OtherError('Number of alleles in ped file (%d) is different than in genome_stats.txt (%d)!'
+                                        % (block.shape[1], alleles.shape[1]))
+        if p + len(block) > pat:
+            raise exceptions.OtherError('Ped file has more patients than genome_stats.txt!')
+        alleles[p:p+len(block)] = block
+        p += len(block)
+    if p != pat:
+        raise exceptions.OtherError('Ped file has less patients than genome_stats.txt!')
+
+    return alleles
+
+
+def open_matrices(outdir):
+    """
+    Making empty matrices of all chromosomes from genome_stats.txt.
+    :return: (tuple) list of chromosomes with numbers of their first and last+1 SNP, list of matrices (memmaps)
+    """
+    stats = open('%sgenome_stats.txt' % outdir, 'r')
+    chs, matrices = [], []
     done = 0
     for line in stats:
         ch, snp, pat = line.split()
         pat, snp = int(pat), int(snp)
-        matrix = np.zeros(shape=(pat, snp, 2), dtype=np.int8)
-        pedfile.seek(0, 0)
-        for p, row in enumerate(pedfile):
-            row = row.split()[6+done:6+done+(2*snp)]
-            s = 0
-            n = nn = False
-            v1 = v2 = -2
-            for a, aa in zip(row[0::2], row[1::2]):
-                if a == '0':
-                    v1 = -1
-                    n = True
-                if aa == '0':
-                    v2 = -1
-                    nn = True
-                if not n or not nn:
-                    for i, base in enumerate(snps_val[ch][s]):
-                        if a == base:
-                            v1 = i
-                        if aa == base:
-                            v2 = i
-                if v1 == -2 or v2 == -2:
-                    raise exceptions.PlinkWrongValue('%d+%d' % (done, s), ch, p, a, aa)
-                matrix[p][s] = [v1, v2]
-                s += 1
-                n = nn = False
-                v1 = v2 = -2
-        np.save('%smatrix_chr%s.npy' % (outdir, ch), matrix)
-        done += 2*snp
-
+        chs.append((ch, done, done+snp))
+        matrices.append(np.lib.format.open_memmap('%smatrix_chr%s.npy' % (outdir, ch), mode='w+', dtype=np.int8,
+                                                  shape=(pat, snp, 2)))
+        done += snp
     stats.close()
-    pedfile.close()
+
+    return chs, matrices
+
+
+def write_matrix(outdir, snps_val, alleles, rows=None):
+
+    rows = rows or block_rows(alleles.shape[1])
+    chs, matrices = open_matrices(outdir)
+    lut = []
+    for ch, _, _ in chs:
+        # values of alleles of every SNP: -1 for missing, number of base in snps_val, -2 if it is not there
+        for bases in snps_val[ch]:
+            values = [-2] * len(BASES)
+            for i, base in enumerate(bases):
+                if base in BASES:
+                    values[BASES.index(base)] = i
+            values[BASES.index('0')] = -1
+            lut.append(values + [-2])
+
+    # every block of patients is scattered into matrices of all chromosomes
+    lut = np.repeat(np.array(lut, dtype=np.int8), 2, axis=0)
+    columns = np.arange(lut.shape[0]) * lut.shape[1]
+    for p in range(0, alleles.shape[0], rows):
+        block = alleles[p:p+rows]
+        values = lut.ravel()[columns + CODES[block]]
+        if (values == -2).any():
+            r, c = np.argwhere(values == -2)[0]
+            c -= c % 2
+            raise wrong_value(chs, c // 2, p + r, chr(block[r, c]), chr(block[r, c+1]))
+        for matrix, (ch, first, last) in zip(matrices, chs):
+            matrix[p:p+len(block)] = values[:, 2*first:2*last].reshape(len(block), last-first, 2)
+
+    for matrix in matrices:
+        matrix.flush()
+
+
+def read_bim(plink, indir):
+    """
+    Reading alleles A1 and A2 of every SNP from bim file.
+    :return: (list) pairs of alleles
+    """
+    bim = []
+    with open('%s%s.bim' % (indir, plink), 'r') as o:
+        for line in o:
+            bim.append(tuple(line.split()[4:6]))
+
+    return bim
+
+
+def read_bed(plink, indir, pat, snp):
+    """
+    Mapping genotypes of SNP-major bed file into memory (every SNP takes (pat+3)//4 bytes, 2 bits per patient,
+    the first patient in the lowest bits).
+    :return: (memmap) matrix SNPs x bytes
+    """
+    filename = '%s%s.bed' % (indir, plink)
+    with open(filename, 'rb') as o:
+        magic = o.read(3)
+    if magic != b'\x6c\x1b\x01':
+        raise exceptions.OtherError('%s is not SNP-major bed file!' % filename)
+    if os.path.getsize(filename) != 3 + snp * ((pat+3)//4):
+        raise exceptions.OtherError('Size of %s does not match %d SNPs and %d patients!' % (filename, snp, pat))
+
+    return np.memmap(filename, dtype=np.uint8, mode='r', offset=3, shape=(snp, (pat+3)//4))
+
+
+def bed_codes(block, pat):
+    """
+    Decoding bytes of bed file: 0 - homozygous A1, 1 - missing, 2 - heterozygous, 3 - homozygous A2.
+    :return: (ndarray) matrix SNPs x patients (uint8)
+    """
+    codes = (block[:, :, np.newaxis] >> np.array([0, 2, 4, 6], dtype=np.uint8)) & 3
+
+    return codes.reshape(len(block), -1)[:, :pat]
+
+
+def write_matrix_bed(outdir, snps_val, bed, bim, pat, snps=4096):
+
+    chs, matrices = open_matrices(outdir)
+    # values of both alleles for every genotype code of every SNP, -2 if allele is not in snps_val
+    lut = np.full(shape=(len(bim), 4, 2), fill_value=-2, dtype=np.int8)
+    i = 0
+    for ch, _, _ in chs:
+        for bases in snps_val[ch]:
+            v1, v2 = [bases.index(a) if a in bases else -2 for a in bim[i]]
+            lut[i] = [[v1, v1], [-1, -1], [v1, v2], [v2, v2]]
+            i += 1
+
+    # bed file is SNP-major, blocks of SNPs are decoded and transposed into matrices of their chromosomes
+    for matrix, (ch, first, last) in zip(matrices, chs):
+        for s in range(first, last, snps):
+            e = min(s+snps, last)
+            codes = bed_codes(bed[s:e], pat)
+            values = lut[np.arange(s, e)[:, np.newaxis], codes]
+            if (values == -2).any():
+                r, p = np.argwhere((values == -2).any(axis=2))[0]
+                a, aa = {0: bim[s+r][:1]*2, 2: bim[s+r], 3: bim[s+r][1:]*2}[codes[r, p]]
+                raise exceptions.PlinkWrongValue('%d+%d' % (2*first, s+r-first), ch, p, a, aa)
+            matrix[:, s-first:e-first] = values.transpose(1, 0, 2)
+        matrix.flush()
 
 
 indir = './'
 overwrite = False
+bed = False
 for q in range(len(sys.argv)):
     if sys.argv[q] == '-plink':
         plink = sys.argv[q+1]
@@ -145,6 +337,8 @@ for q in range(len(sys.argv)):
         outdir = sys.argv[q+1]
     if sys.argv[q] == '-overwrite':
         overwrite = True
+    if sys.argv[q] == '-bed':
+        bed = True
 
 if 'outdir' not in globals():
     outdir = indir
@@ -152,5 +346,16 @@ if 'outdir' not in globals():
 if 'plink' not in globals():
     raise exceptions.NoParameterError('plink', 'name of plink files')
 
-snps_val = write_snps_list(plink, indir, outdir, overwrite)
-write_matrix(plink, indir, outdir, snps_val)
+if bed:
+    # binary plink files are read without any text parsing of genotypes
+    bim = read_bim(plink, indir)
+    with open('%sgenome_stats.txt' % outdir, 'r') as stats:
+        pat = int(stats.readline().split()[2])
+    genotypes = read_bed(plink, indir, pat, len(bim))
+    snps_val = write_snps_list('%s%s.bim' % (indir, plink), outdir, overwrite,
+                               make_snps_count_bed(genotypes, bim, pat))
+    write_matrix_bed(outdir, snps_val, genotypes, bim, pat)
+else:
+    alleles = read_ped(plink, indir, outdir)
+    snps_val = write_snps_list('%s%s.map' % (indir, plink), outdir, overwrite, make_snps_count(alleles))
+    write_matrix(outdir, snps_val, alleles)
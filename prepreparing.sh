@@ -10,7 +10,7 @@ function pooling {
 
 # tar 1
 # gz 2
-# filtered_snp 3
+# filtered_snp 3 (1 - filtering by python scripts, 2 - SelectVariants of GATK)
 # do stats 4
 # do matrix 5
 # chromosome number 6
@@ -18,13 +18,32 @@ function pooling {
 # filtered vcf file name 8
 # directory of files (indir) 9
 # directory of matrices (outdir) 10
-# dir to gatk 11
-# genome reference 12
+# stream compressed files 11
+# threads for decompression 12
+# processes parsing one vcf file 13
+# dir to gatk 14
+# genome reference 15 (last, because it can be empty)
 
         vcf=${9}${7}
         vcfsnps=${9}${8}"_chr${6}_SNPs.vcf"
+        vcfin=${vcfsnps}
+        filter=""
+
+        if [[ ${11} -eq 1 ]]; then
+
+                # compressed file is read directly by python scripts, no decompressed copy is written to disk
+                if [ "$1" -eq 1 ] && [ "$2" -eq 1 ]; then
+                        vcf=${vcf}".tar.gz"
+                elif [[ $1 -eq 1 ]]; then
+                        vcf=${vcf}".tar"
+                elif [[ $2 -eq 1 ]]; then
+                        vcf=${vcf}".gz"
+                fi
+                if [[ $3 -ne 2 ]]; then
+                        vcfin=${vcf}
+                fi
 
-        if [ "$1" -eq 1 ] && [ "$2" -eq 1 ]; then
+        elif [ "$1" -eq 1 ] && [ "$2" -eq 1 ]; then
 
                 tend=".tar.gz"
                 tarfile=${vcf}${tend}
@@ -50,20 +69,30 @@ function pooling {
         fi
 
         if [[ $3 -eq 1 ]]; then
-                echo "running SelectVariants for chr=$4"
-                "${11}"gatk SelectVariants -R "${12}" -V "${vcf}" -O "${vcfsnps}" -select-type-to-include SNP
+                # records other than SNPs are skipped while the vcf file is parsed, no filtered vcf file is written
+                vcfin=${vcf}
+                filter="-snps_only"
+        elif [[ $3 -eq 2 ]]; then
+                echo "running SelectVariants for chr=$6"
+                "${14}"gatk SelectVariants -R "${15}" -V "${vcf}" -O "${vcfsnps}" -select-type-to-include SNP
                 echo "$6 SNPs.vcf done!"
         fi
 
-        if [[ $4 -eq 1 ]]; then
+        if [[ $4 -eq 1 ]] && [[ $5 -ne 1 ]]; then
                 echo "stats for chr=$6 started!"
-                python3 vcf_stats.py -input "${vcfsnps}"
+                python3 vcf_stats.py -input "${vcfin}" -threads "${12}" ${filter}
                 echo "stats file for chr=$6 done!"
         fi
 
         if [[ $5 -eq 1 ]]; then
                 echo "running vcf_to_matrix for chr $6"
-                python3 vcf_to_matrix.py -chr "$6" -input "${vcfsnps}" -outdir "${10}" >> "${10}genome_stats.txt"
+                if [[ $4 -eq 1 ]]; then
+                        # stats are collected during the same reading of vcf file
+                        python3 vcf_to_matrix.py -chr "$6" -input "${vcfin}" -outdir "${10}" -threads "${12}" -procs "${13}" -stats ${filter} >> "${10}genome_stats.txt"
+                        echo "stats file for chr=$6 done!"
+                else
+                        python3 vcf_to_matrix.py -chr "$6" -input "${vcfin}" -outdir "${10}" -threads "${12}" -procs "${13}" ${filter} >> "${10}genome_stats.txt"
+                fi
                 echo "matrices for chr $6 done!"
         fi
         # after this, run only once each function:
@@ -84,6 +113,9 @@ gz=0
 snp=0
 stats=0
 matrix=0
+stream=0
+threads=1
+procs=1
 
 #name of input vcf files
 vcfstart='default_chr'
@@ -118,7 +150,19 @@ while [[ "$1" != "" ]]; do
                                 ;;
         -gz )                   gz=1
                                 ;;
-        -snp )                  snp=1
+        -stream )               stream=1
+                                ;;
+        -threads )              shift
+                                threads=$1
+                                ;;
+        -procs )                shift
+                                procs=$1
+                                ;;
+        -snp )                  if [[ $snp -ne 2 ]]; then
+                                        snp=1
+                                fi
+                                ;;
+        -gatk )                 snp=2
                                 ;;
         -stats )                stats=1
                                 ;;
@@ -199,7 +243,7 @@ if [[ $all -eq 1 ]]; then
                         vcfname=${vcfstart}${ch}${vcfend}
                 fi
 
-                job_pool_run pooling ${tar} ${gz} ${snp} ${stats} ${matrix} "${ch}" "${vcfname}" "${base}" "${files_dir}" "${matrices_dir}" "${gatk_dir}" "${ref}"
+                job_pool_run pooling ${tar} ${gz} ${snp} ${stats} ${matrix} "${ch}" "${vcfname}" "${base}" "${files_dir}" "${matrices_dir}" ${stream} ${threads} ${procs} "${gatk_dir}" "${ref}"
 
         done
 
@@ -207,7 +251,7 @@ if [[ $all -eq 1 ]]; then
         echo "job_pool_nerrors: ${job_pool_nerrors}"
 else
         vcfname=${vcfstart}${chr}${vcfend}
-        pooling ${tar} ${gz} ${snp} ${stats} ${matrix} "${chr}" "${vcfname}" "${base}" "${files_dir}" "${matrices_dir}" "${gatk_dir}" "${ref}"
+        pooling ${tar} ${gz} ${snp} ${stats} ${matrix} "${chr}" "${vcfname}" "${base}" "${files_dir}" "${matrices_dir}" ${stream} ${threads} ${procs} "${gatk_dir}" "${ref}"
 fi
 
 if [[ $matrix -eq 1 ]]; then
@@ -0,0 +1,60 @@
+import os
+import subprocess
+import sys
+import tempfile
+from collections import OrderedDict
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+import corporate_funcs as funcs
+
+
+def write_vcf(filename, pids):
+
+    with open(filename, 'w') as o:
+        o.write('##fileformat=VCFv4.2\n')
+        o.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n' % '\t'.join(pids))
+        for i, pos in enumerate([100, 200, 300, 400]):
+            calls = ['0/0', '0/1', '1/1', './.']
+            o.write('21\t%d\t.\tA\tG\t.\tPASS\t.\tGT\t%s\n' % (pos, '\t'.join(calls[(i + j) % 4]
+                                                                          for j in range(len(pids)))))
+
+
+def run(script, *args):
+
+    return subprocess.run([sys.executable, os.path.join(ROOT, script)] + list(args), cwd=ROOT, check=True,
+                          stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def make_y(matrices, pids):
+
+    with open(os.path.join(matrices, 'pid_chr.txt'), 'w') as o:
+        o.write(''.join('%s\n' % pid for pid in pids))
+    with open(os.path.join(matrices, 'diagnoses.txt'), 'w') as o:
+        o.write(''.join('%d\n' % (i % 2) for i in range(len(pids))))
+    run('makeY.py', '-indir', matrices, '-outdir', matrices)
+
+
+def test_append_then_makeY_updates_patients():
+
+    with tempfile.TemporaryDirectory() as directory:
+        matrices = os.path.join(directory, 'matrices') + os.sep
+        os.makedirs(matrices)
+        old, new = ['P%d' % i for i in range(3)], ['P%d' % i for i in range(3, 5)]
+        write_vcf(os.path.join(directory, 'old.vcf'), old)
+        write_vcf(os.path.join(directory, 'new.vcf'), new)
+
+        stats = run('vcf_to_matrix.py', '-chr', '21', '-input', os.path.join(directory, 'old.vcf'), '-outdir', matrices)
+        with open(matrices + 'genome_stats.txt', 'w') as g:
+            g.write(stats)
+        make_y(matrices, old)
+        assert funcs.patients(OrderedDict(d=directory + os.sep)) == {'d': 3}
+
+        run('vcf_to_matrix.py', '-chr', '21', '-input', os.path.join(directory, 'new.vcf'), '-outdir', matrices,
+            '-append')
+        make_y(matrices, old + new)
+        with open(matrices + 'genome_stats.txt', 'r') as g:
+            assert g.read().split() == ['21', '4', '5', '5']
+        funcs._manifests.clear()
+        assert funcs.patients(OrderedDict(d=directory + os.sep)) == {'d': 5}
@@ -0,0 +1,1124 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import io
+import numpy as np
+import os
+import queue
+import struct
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+import exceptions
+
+'''
+Functions shared by scripts reading vcf files (vcf_to_matrix.py, vcf_stats.py).
+'''
+
+# number of SNPs kept in one chunk of GenotypeBuffer
+CHUNK = 4096
+# number of vcf records decoded at once
+BLOCK = 256
+# size of buffer used while reading compressed files
+READ_BUFFER = 1 << 20
+# number of records between entries of position index of uncompressed vcf file
+INDEX_STEP = 256
+
+# ascii code -> value of allele, -1 for no call ('.') and every other character
+ALLELES = np.full(256, -1, dtype=np.int8)
+ALLELES[ord('0'):ord('9')+1] = np.arange(10)
+# characters which can follow genotype (GT) subfield
+GT_END = np.zeros(256, dtype=bool)
+GT_END[[ord(':'), ord('\t'), ord('\n'), ord('\r')]] = True
+# characters separating alleles in genotype (GT) subfield
+GT_SEP = np.zeros(256, dtype=bool)
+GT_SEP[[ord('/'), ord('|')]] = True
+# single nucleobases which can be REF or ALT allele of SNP
+BASES = frozenset([b'A', b'C', b'G', b'T', b'N', b'a', b'c', b'g', b't', b'n'])
+
+
+class GenotypeBuffer(object):
+    """
+    Growable buffer for genotype values of one chromosome, filled SNP by SNP (or block of SNPs by block of SNPs).
+    Values are written into fixed-size int8 chunks (rows are SNPs, columns are patients), so number of SNPs does not
+    have to be known before reading the vcf file. If spill directory is given, full chunks are written into temporary
+    file in that directory instead of being kept in memory.
+    """
+
+    def __init__(self, pat, chunk=CHUNK, spill=None):
+        self.pat = pat
+        self.chunk = chunk
+        self.snp = 0
+        self.chunks = []
+        self.current = np.empty(shape=(chunk, pat), dtype=np.int8)
+        self.fill = 0
+        if spill is not None:
+            fd, self.spillfile = tempfile.mkstemp(suffix='.int8', prefix='genotypes_', dir=spill)
+            self.spill = os.fdopen(fd, 'wb')
+        else:
+            self.spillfile = None
+            self.spill = None
+
+    def append(self, block):
+        """
+        Adding values of one SNP (vector of length pat) or block of SNPs (matrix snps x pat) to the buffer.
+        """
+        block = np.atleast_2d(block)
+        done = 0
+        while done < block.shape[0]:
+            n = min(self.chunk - self.fill, block.shape[0] - done)
+            self.current[self.fill:self.fill+n] = block[done:done+n]
+            self.fill += n
+            done += n
+            if self.fill == self.chunk:
+                self.flush()
+        self.snp += block.shape[0]
+
+    def flush(self):
+        if self.fill == 0:
+            return
+        if self.spill is not None:
+            self.current[:self.fill].tofile(self.spill)
+        else:
+            self.chunks.append(self.current[:self.fill])
+            self.current = np.empty(shape=(self.chunk, self.pat), dtype=np.int8)
+        self.fill = 0
+
+    def blocks(self):
+        """
+        Giving back buffered values in SNP-major blocks (SNPs x patients), in the order in which they were added.
+        """
+        self.flush()
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+            if self.snp:
+                values = np.memmap(self.spillfile, dtype=np.int8, mode='r', shape=(self.snp, self.pat))
+                for start in range(0, self.snp, self.chunk):
+                    yield values[start:start+self.chunk]
+                del values
+            os.remove(self.spillfile)
+        else:
+            while self.chunks:
+                yield self.chunks.pop(0)
+
+    def finalize(self, out=None):
+        """
+        Writing all buffered values into matrix patients x SNPs.
+        :param out: (array-like) matrix of shape (pat, snp) which should be filled, e.g. memory-mapped npy file,
+        if not given new matrix is allocated
+        :return: filled matrix
+        """
+        if out is None:
+            out = np.empty(shape=(self.pat, self.snp), dtype=np.int8)
+        start = 0
+        for values in self.blocks():
+            out[:, start:start+values.shape[0]] = values.T
+            start += values.shape[0]
+        return out
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    Reader of BGZF file (gzip file made of independent blocks, e.g. made by bgzip) decompressing blocks in the pool
+    of threads. Blocks are read in order, decompressed in parallel (zlib releases GIL) and given back in order.
+    """
+
+    def __init__(self, inp, threads, start=0):
+        self.f = open(inp, 'rb')
+        self.f.seek(start)
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.pending = deque()
+        self.data = b''
+        self.pos = 0
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def read_block(self):
+        header = self.f.read(12)
+        if len(header) < 12:
+            return None
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.f.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            slen = struct.unpack('<H', extra[i+2:i+4])[0]
+            if extra[i:i+2] == b'BC':
+                bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise IOError('File %s is not in BGZF format!' % self.f.name)
+        return self.f.read(bsize - xlen - 11)[:-8]
+
+    def fill(self):
+        while not self.eof and len(self.pending) < 4 * self.threads:
+            cdata = self.read_block()
+            if cdata is None:
+                self.eof = True
+            else:
+                self.pending.append(self.pool.submit(zlib.decompress, cdata, -15))
+
+    def readinto(self, b):
+        while self.pos >= len(self.data):
+            self.fill()
+            if not self.pending:
+                return 0
+            self.data = self.pending.popleft().result()
+            self.pos = 0
+        n = min(len(b), len(self.data) - self.pos)
+        b[:n] = self.data[self.pos:self.pos+n]
+        self.pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False)
+            self.f.close()
+        super().close()
+
+
+def is_bgzf(inp):
+    with open(inp, 'rb') as f:
+        header = f.read(18)
+    return len(header) == 18 and header[:2] == b'\x1f\x8b' and bool(header[3] & 4) and header[12:14] == b'BC'
+
+
+def is_compressed(inp):
+    if inp.endswith(('.tar', '.tar.gz', '.tgz')):
+        return True
+    with open(inp, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def open_vcf(inp, threads=1):
+    """
+    Opening vcf file in binary mode. Compressed files are read as streams, without writing decompressed copy to disk:
+    - .tar, .tar.gz - first regular file from the archive,
+    - gzip (.vcf.gz) - read by gzip module, or if it is BGZF file and more than one thread is given, with blocks
+    decompressed in parallel.
+    :param inp: (str) path to vcf file
+    :param threads: (int) number of threads decompressing BGZF blocks
+    :return: file object
+    """
+    if inp.endswith(('.tar', '.tar.gz', '.tgz')):
+        tar = tarfile.open(inp, 'r:*')
+        for member in tar:
+            if member.isfile():
+                return io.BufferedReader(tar.extractfile(member), buffer_size=READ_BUFFER)
+        raise IOError('There is no file in the archive %s!' % inp)
+    with open(inp, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        if threads > 1 and is_bgzf(inp):
+            return io.BufferedReader(BgzfReader(inp, threads), buffer_size=READ_BUFFER)
+        return io.BufferedReader(gzip.open(inp, 'rb'), buffer_size=READ_BUFFER)
+    return open(inp, 'rb')
+
+
+def parse_regions(region=None, bed=None):
+    """
+    Reading regions which should be parsed. Overlapping regions are merged.
+    :param region: (str) one region 'chr:start-end' (1-based, both ends included) or whole chromosome 'chr'
+    :param bed: (str) path to bed file, regions in the first three columns (0-based, end excluded)
+    :return: (list) sorted triples (chromosome, start, end), 1-based, both ends included
+    """
+    regions = []
+    if region is not None:
+        try:
+            if ':' in region:
+                ch, scope = region.rsplit(':', 1)
+                start, end = scope.replace(',', '').split('-')
+                regions.append((ch, int(start), int(end)))
+            else:
+                regions.append((region, 1, 2**31))
+        except ValueError:
+            raise exceptions.WrongValueError('-region', region, 'Region should be given as chr:start-end.')
+    if bed is not None:
+        with open(bed, 'r') as b:
+            for line in b:
+                line = line.split()
+                if not line or line[0].startswith(('#', 'track', 'browser')):
+                    continue
+                regions.append((line[0], int(line[1]) + 1, int(line[2])))
+    for ch, start, end in regions:
+        if start > end:
+            raise exceptions.WrongValueError('-region', '%s:%d-%d' % (ch, start, end), 'Start is after end.')
+
+    regions.sort(key=lambda r: (chrom_key(r[0]), r[1]))
+    merged = []
+    for ch, start, end in regions:
+        if merged and chrom_key(merged[-1][0]) == chrom_key(ch) and start <= merged[-1][2] + 1:
+            merged[-1] = (merged[-1][0], merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((ch, start, end))
+    return merged
+
+
+def chrom_key(ch):
+    """
+    Name of chromosome without 'chr' prefix, so '19' and 'chr19' are the same chromosome.
+    """
+    if isinstance(ch, bytes):
+        ch = ch.decode()
+    if ch.startswith('chr'):
+        ch = ch[3:]
+    return ch
+
+
+def chrom_name(ch):
+    """
+    Name of chromosome used in names of output files - number, X is 23 and Y is 24 (as in prepreparing.sh).
+    """
+    ch = chrom_key(ch)
+    return {'X': '23', 'Y': '24'}.get(ch, ch)
+
+
+def index_file(inp):
+    return inp + '.vidx.npz'
+
+
+def build_index(inp):
+    """
+    Making position index of uncompressed vcf file: chromosome, position and byte offset of the first record of every
+    chromosome and of every INDEX_STEP-th record. Index is written next to the vcf file (index_file).
+    :return: (tuple) list of names of chromosomes, array of rows (number of chromosome, position, offset)
+    """
+    names = []
+    rows = []
+    with open(inp, 'rb') as o:
+        offset = 0
+        k = 0
+        for line in o:
+            if not line.startswith(b'#') and len(line) > 1:
+                ch, pos = line.split(b'\t', 2)[:2]
+                ch = ch.decode()
+                if not names or names[-1] != ch:
+                    names.append(ch)
+                    k = 0
+                if k % INDEX_STEP == 0:
+                    rows.append((len(names) - 1, int(pos), offset))
+                k += 1
+            offset += len(line)
+    index = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    np.savez(index_file(inp), names=np.array(names, dtype=str), index=index)
+    return names, index
+
+
+def load_index(inp):
+    """
+    Loading position index of uncompressed vcf file, the index is made at first use and again if vcf file is newer.
+    """
+    ifile = index_file(inp)
+    if os.path.isfile(ifile) and os.path.getmtime(ifile) >= os.path.getmtime(inp):
+        with np.load(ifile) as idx:
+            return list(idx['names']), idx['index']
+    return build_index(inp)
+
+
+def read_hts_index(ifile):
+    """
+    Reading tabix (.tbi) or CSI (.csi) index of BGZF-compressed vcf file.
+    :return: (tuple) names of chromosomes, min_shift and depth of binning scheme, list (for every chromosome) of
+    dictionaries bin -> list of chunks (virtual offsets of the beginning and the end)
+    """
+    with gzip.open(ifile, 'rb') as f:
+        data = f.read()
+    magic = data[:4]
+    if magic == b'TBI\x01':
+        min_shift, depth = 14, 5
+        n_ref = struct.unpack('<i', data[4:8])[0]
+        names = data[36:36 + struct.unpack('<i', data[32:36])[0]]
+        pos = 36 + len(names)
+    elif magic == b'CSI\x01':
+        min_shift, depth, l_aux = struct.unpack('<3i', data[4:16])
+        aux = data[16:16 + l_aux]
+        names = aux[28:28 + struct.unpack('<i', aux[24:28])[0]] if l_aux >= 28 else b''
+        pos = 16 + l_aux
+        n_ref = struct.unpack('<i', data[pos:pos+4])[0]
+        pos += 4
+    else:
+        raise IOError('File %s is not tabix or CSI index!' % ifile)
+    names = [name.decode() for name in names.split(b'\x00')[:n_ref]]
+
+    bins = []
+    for _ in range(n_ref):
+        n_bin = struct.unpack('<i', data[pos:pos+4])[0]
+        pos += 4
+        ref = {}
+        for _ in range(n_bin):
+            if magic == b'TBI\x01':
+                b, n_chunk = struct.unpack('<Ii', data[pos:pos+8])
+                pos += 8
+            else:
+                b, _, n_chunk = struct.unpack('<IQi', data[pos:pos+16])
+                pos += 16
+            chunks = struct.unpack('<%dQ' % (2 * n_chunk), data[pos:pos + 16 * n_chunk])
+            ref[b] = list(zip(chunks[::2], chunks[1::2]))
+            pos += 16 * n_chunk
+        if magic == b'TBI\x01':
+            n_intv = struct.unpack('<i', data[pos:pos+4])[0]
+            pos += 4 + 8 * n_intv
+        bins.append(ref)
+    return names, min_shift, depth, bins
+
+
+def reg2bins(beg, end, min_shift, depth):
+    """
+    Bins of binning scheme (as in SAM/tabix specification) which overlap 0-based region [beg, end).
+    """
+    bins = []
+    end -= 1
+    s = min_shift + depth * 3
+    t = 0
+    for level in range(depth + 1):
+        bins.extend(range(t + (beg >> s), t + (end >> s) + 1))
+        s -= 3
+        t += 1 << (level * 3)
+    return bins
+
+
+def region_offsets(inp, regions):
+    """
+    Finding where records of every region begin in vcf file - using tabix/CSI index of BGZF file (virtual offsets)
+    or own position index of uncompressed file (byte offsets, index is made if it does not exist).
+    :return: (list) pairs (region, offset) - offset is None if there are no records of the region, or None if vcf file
+    cannot be read from given offsets (e.g. gzip file without index)
+    """
+    offsets = []
+    if not is_compressed(inp):
+        names, index = load_index(inp)
+        names = [chrom_key(name) for name in names]
+        for region in regions:
+            ch, start, _ = region
+            if chrom_key(ch) not in names:
+                offsets.append((region, None))
+                continue
+            rows = index[index[:, 0] == names.index(chrom_key(ch))]
+            k = max(np.searchsorted(rows[:, 1], start, side='left') - 1, 0)
+            offsets.append((region, int(rows[k, 2])))
+        return offsets
+
+    for ifile in [inp + '.tbi', inp + '.csi']:
+        if os.path.isfile(ifile) and is_bgzf(inp):
+            break
+    else:
+        return None
+    names, min_shift, depth, bins = read_hts_index(ifile)
+    names = [chrom_key(name) for name in names]
+    for region in regions:
+        ch, start, end = region
+        voffset = None
+        if chrom_key(ch) in names:
+            ref = bins[names.index(chrom_key(ch))]
+            end = min(end, 2 ** (min_shift + depth * 3) - 1)
+            for b in reg2bins(start - 1, end, min_shift, depth):
+                for beg, _ in ref.get(b, []):
+                    if voffset is None or beg < voffset:
+                        voffset = beg
+        offsets.append((region, voffset))
+    return offsets
+
+
+def in_region(line, region):
+    """
+    Checking where vcf record is relative to region.
+    :return: (int) -1 if it is before the region, 0 if it is inside, 1 if it is after the region (or on other
+    chromosome)
+    """
+    ch, pos = line.split(b'\t', 2)[:2]
+    if chrom_key(ch) != chrom_key(region[0]):
+        return 1
+    pos = int(pos)
+    if pos < region[1]:
+        return -1
+    if pos > region[2]:
+        return 1
+    return 0
+
+
+def region_lines(inp, regions, threads=1):
+    """
+    Giving back raw lines of vcf records from given regions. Uncompressed files and BGZF files with tabix/CSI index
+    are read only from the beginning of every region, other compressed files are read as a whole (but only records
+    from the regions are given back, so only they are decoded).
+    :param inp: (str) path to vcf file
+    :param regions: (list) sorted, not overlapping regions (see parse_regions)
+    :param threads: (int) number of threads decompressing BGZF blocks
+    :return: generator of raw lines
+    """
+    offsets = region_offsets(inp, regions)
+    if offsets is None:
+        o = open_vcf(inp, threads)
+        for line in o:
+            if line.startswith(b'#') or len(line) <= 1:
+                continue
+            for region in regions:
+                if in_region(line, region) == 0:
+                    yield line
+                    break
+        o.close()
+        return
+
+    compressed = is_compressed(inp)
+    for region, offset in offsets:
+        if offset is None:
+            continue
+        if compressed:
+            o = io.BufferedReader(BgzfReader(inp, threads, offset >> 16), buffer_size=READ_BUFFER)
+            o.read(offset & 0xFFFF)
+        else:
+            o = open(inp, 'rb')
+            o.seek(offset)
+        for line in o:
+            if line.startswith(b'#') or len(line) <= 1:
+                continue
+            where = in_region(line, region)
+            if where == 1:
+                break
+            if where == 0:
+                yield line
+        o.close()
+
+
+def read_keep(keepfile=None, diagfile=None):
+    """
+    Reading IDs of patients which should be parsed.
+    :param keepfile: (str) file with IDs of patients, one in every line
+    :param diagfile: (str) file with ID and diagnosis of patient in every line (separated by tab, space or comma),
+    patients with diagnosis DIF, NN or 2 (see make_pid-diagnoses.py and makeY.py) are not kept
+    :return: (set) IDs of patients, None if no file is given (all patients are kept)
+    """
+    if keepfile is None and diagfile is None:
+        return None
+    keep = set()
+    if keepfile is not None:
+        with open(keepfile, 'r') as f:
+            for line in f:
+                if line.strip():
+                    keep.add(line.strip())
+    if diagfile is not None:
+        with open(diagfile, 'r') as f:
+            for line in f:
+                line = line.replace(',', ' ').split()
+                if len(line) >= 2 and line[1] not in ['DIF', 'NN', '2']:
+                    keep.add(line[0])
+    return keep
+
+
+def select_patients(pids, keep):
+    """
+    Selecting patients which should be parsed.
+    :param pids: (list) IDs of all patients in vcf file
+    :param keep: (set) IDs of patients which should be kept, None if all
+    :return: (tuple) IDs of selected patients, numbers of their sample fields (None if all patients are kept)
+    """
+    if keep is None:
+        return pids, None
+    cols = [j for j, pid in enumerate(pids) if pid in keep]
+    if not cols:
+        raise exceptions.OtherError('None of patients from vcf file should be kept!')
+    return [pids[j] for j in cols], cols
+
+
+def read_blocks(o, block=BLOCK):
+    """
+    Reading records of vcf file (opened in binary mode, after the header) in blocks.
+    :param o: file object
+    :param block: (int) number of records in one block
+    :return: generator of lists of raw lines
+    """
+    lines = []
+    for line in o:
+        if len(line) > 1:
+            lines.append(line)
+            if len(lines) == block:
+                yield lines
+                lines = []
+    if lines:
+        yield lines
+
+
+def decode_gt(field):
+    """
+    Decoding one sample field (bytes) in the way vcf_to_matrix always did it - values of alleles from GT subfield,
+    the second allele is the one written into matrices. Both values are -1 if there is no call (or it is not diploid).
+    :return: (tuple) value of the first allele, value of the second allele
+    """
+    gt = field.split(b':')[0].replace(b'|', b'/').split(b'/')
+    try:
+        second = int(gt[1])
+    except (ValueError, IndexError):
+        return -1, -1
+    try:
+        first = int(gt[0])
+    except ValueError:
+        first = -1
+    return first, second
+
+
+def decode_line(line, pat, cols=None):
+    fields = line.split()[9:]
+    if cols is not None:
+        fields = [fields[c] if c < len(fields) else b'' for c in cols]
+        pat = len(cols)
+    values = np.empty(shape=(2, pat), dtype=np.int8)
+    for j, e in enumerate(fields):
+        values[:, j] = decode_gt(e)
+    return values
+
+
+def decode_block(lines, pat, cols=None):
+    """
+    Decoding genotypes of block of vcf records at once.
+    Lines are joined into one buffer, positions of sample fields are found from positions of tabs and genotypes are
+    read with lookup tables from bytes following the beginning of every field. Fields which do not look like
+    one-digit diploid call (e.g. '10/1' or '1') are decoded one by one by decode_gt.
+    :param lines: (list) raw lines of vcf records (bytes)
+    :param pat: (int) number of patients
+    :param cols: (array-like) numbers of sample fields which should be decoded (other fields are not read), all if None
+    :return: (tuple) two matrices of shape (len(lines), pat) (or (len(lines), len(cols))) with values of the first
+    and the second allele, -1 for no call
+    """
+    n = len(lines)
+    buf = b''.join(lines) + b'\n\n\n\n'
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    tabs = np.flatnonzero(arr == 9)
+
+    # every record should have exactly 8 + pat tabs and none of them can be outside its line
+    ends = np.cumsum([len(line) for line in lines])
+    aligned = tabs.size == n * (pat + 8)
+    if aligned:
+        tabs = tabs.reshape(n, pat + 8)
+        aligned = not ((tabs[:, -1] >= ends).any() or (tabs[1:, 0] < ends[:-1]).any())
+    if not aligned:
+        values = np.array([decode_line(line, pat, cols) for line in lines], dtype=np.int8).reshape(
+            n, 2, pat if cols is None else len(cols))
+        return values[:, 0], values[:, 1]
+
+    if cols is None:
+        cols = np.arange(pat)
+    cols = np.asarray(cols, dtype=np.int64)
+    starts = tabs[:, 8 + cols] + 1
+    first = ALLELES[arr[starts]]
+    second = ALLELES[arr[starts + 2]]
+    regular = GT_SEP[arr[starts + 1]] & GT_END[arr[starts + 3]]
+    if not regular.all():
+        for i, j in zip(*np.nonzero(~regular)):
+            end = tabs[i, cols[j] + 9] if cols[j] + 1 < pat else ends[i]
+            first[i, j], second[i, j] = decode_gt(buf[starts[i, j]:end].rstrip())
+    first[second == -1] = -1
+    return first, second
+
+
+def parse_ints(arr, starts, stops, width=9):
+    """
+    Reading non-negative integers written in buffer between starts and stops (arrays of positions of the same shape).
+    :return: (ndarray) int64 values, -1 if the text is empty, too long or is not a number (e.g. '.')
+    """
+    length = stops - starts
+    valid = (length > 0) & (length <= width)
+    values = np.zeros(starts.shape, dtype=np.int64)
+    for d in range(width):
+        inside = d < length
+        if not inside.any():
+            break
+        b = arr[np.minimum(starts + d, arr.size - 1)].astype(np.int64) - ord('0')
+        digit = (b >= 0) & (b <= 9)
+        valid &= ~inside | digit
+        values = np.where(inside & digit, values * 10 + b, values)
+    values[~valid] = -1
+    return values
+
+
+def format_values(lines, key, pat, cols=None):
+    """
+    Reading integer subfield (e.g. GQ or DP) of sample fields of block of vcf records. Positions of subfields are found
+    from positions of tabs and colons in the joined buffer, every record can have different FORMAT.
+    :param lines: (list) raw lines of vcf records (bytes)
+    :param key: (bytes) name of the subfield in FORMAT column
+    :param pat: (int) number of patients
+    :param cols: (array-like) numbers of sample fields which should be read, all if None
+    :return: (ndarray) int64 matrix of shape (len(lines), pat) (or (len(lines), len(cols))), -1 if the value is
+    missing
+    """
+    n = len(lines)
+    if cols is None:
+        cols = np.arange(pat)
+    cols = np.asarray(cols, dtype=np.int64)
+    values = np.full((n, len(cols)), -1, dtype=np.int64)
+    buf = b''.join(lines) + b'\n\n\n\n'
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    tabs = np.flatnonzero(arr == 9)
+    ends = np.cumsum([len(line) for line in lines])
+    aligned = tabs.size == n * (pat + 8)
+    if aligned:
+        tabs = tabs.reshape(n, pat + 8)
+        aligned = not ((tabs[:, -1] >= ends).any() or (tabs[1:, 0] < ends[:-1]).any())
+    if not aligned:
+        for i, line in enumerate(lines):
+            fields = line.rstrip().split(b'\t')
+            keys = fields[8].split(b':') if len(fields) > 8 else []
+            if key not in keys:
+                continue
+            k = keys.index(key)
+            for j, c in enumerate(cols):
+                if 9 + c >= len(fields):
+                    break
+                field = fields[9 + c].split(b':')
+                if k < len(field) and field[k].isdigit():
+                    values[i, j] = int(field[k])
+        return values
+
+    # end of every sample field - next tab or end of line (without new line characters)
+    stops = np.empty(shape=(n, pat), dtype=np.int64)
+    stops[:, :-1] = tabs[:, 9:]
+    stops[:, -1] = [end - len(line) + len(line.rstrip(b'\r\n')) for end, line in zip(ends, lines)]
+    stops = stops[:, cols]
+    starts = tabs[:, 8 + cols] + 1
+    colons = np.flatnonzero(arr == ord(':'))
+
+    groups = {}
+    for i, line in enumerate(lines):
+        groups.setdefault(line.split(b'\t', 9)[8], []).append(i)
+    for fmt, rows in groups.items():
+        keys = fmt.split(b':')
+        if key not in keys:
+            continue
+        k = keys.index(key)
+        s, e = starts[rows], stops[rows]
+        present = np.ones(s.shape, dtype=bool)
+        if k > 0:
+            if not colons.size:
+                continue
+            # subfield begins after k-th colon of the sample field
+            idx = np.searchsorted(colons, s) + k - 1
+            present = idx < colons.size
+            c = colons[np.minimum(idx, colons.size - 1)]
+            present &= c < e
+            s = c + 1
+        if colons.size:
+            idx = np.searchsorted(colons, s)
+            c = colons[np.minimum(idx, colons.size - 1)]
+            e = np.where((idx < colons.size) & (c < e), c, e)
+        values[rows] = np.where(present, parse_ints(arr, s, e), -1)
+    return values
+
+
+class QualityMask(object):
+    """
+    Masking calls of low quality - calls with genotype quality (GQ) or read depth (DP) below thresholds are changed into
+    missing calls (-1). Calls without given subfield are not masked. Number of masked calls of every SNP is collected.
+    """
+
+    def __init__(self, min_gq=None, min_dp=None):
+        self.thresholds = [(k, t) for k, t in [(b'GQ', min_gq), (b'DP', min_dp)] if t is not None]
+        self.masked = []
+
+    def failing(self, lines, second, pat, cols=None):
+        """
+        Finding calls of low quality (it does not change state of the mask, so it can be run by many threads).
+        :return: (ndarray) boolean matrix of the same shape as second
+        """
+        fail = np.zeros(shape=second.shape, dtype=bool)
+        for key, threshold in self.thresholds:
+            values = format_values(lines, key, pat, cols)
+            fail |= (values != -1) & (values < threshold)
+        fail &= second != -1
+        return fail
+
+    def apply(self, lines, first, second, pat, cols=None, fail=None):
+        if fail is None:
+            fail = self.failing(lines, second, pat, cols)
+        first[fail] = -1
+        second[fail] = -1
+        self.masked.append(fail.sum(axis=1).astype(np.int32))
+
+    def select(self, keep):
+        """
+        Leaving counts only for SNPs from the last block which are kept (see VariantFilter).
+        """
+        self.masked[-1] = self.masked[-1][keep]
+
+    def merge(self, other):
+        self.masked += other.masked
+
+    def counts(self):
+        return np.concatenate(self.masked) if self.masked else np.zeros(shape=(0,), dtype=np.int32)
+
+
+class VariantFilter(object):
+    """
+    Quality control of SNPs - SNPs with minor allele frequency below min_maf or with fraction of missing calls above
+    max_missing are not written into matrices. Excluded SNPs are collected with their MAF and fraction of missing calls.
+    """
+
+    def __init__(self, min_maf=None, max_missing=None):
+        self.min_maf = min_maf
+        self.max_missing = max_missing
+        self.excluded = []
+
+    def select(self, lines, first, second):
+        """
+        :return: (ndarray) boolean vector - if SNP passes the filters
+        """
+        pat = first.shape[1]
+        called = (first != -1) & (second != -1)
+        ncalled = called.sum(axis=1)
+        alt = ((first > 0) & called).sum(axis=1) + ((second > 0) & called).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            af = alt / (2 * ncalled)
+        maf = np.nan_to_num(np.minimum(af, 1 - af))
+        missing = (pat - ncalled) / max(pat, 1)
+        keep = np.ones(shape=(len(lines),), dtype=bool)
+        if self.min_maf is not None:
+            keep &= maf >= self.min_maf
+        if self.max_missing is not None:
+            keep &= missing <= self.max_missing
+        for i in np.flatnonzero(~keep):
+            line = lines[i].split(b'\t', 5)
+            self.excluded.append(b'%s\t%s\t%s\t%.4f\t%.4f\n' % (line[1], line[3], line[4], maf[i], missing[i]))
+        return keep
+
+    def merge(self, other):
+        self.excluded += other.excluded
+
+    def write(self, outp):
+        """
+        Writing excluded SNPs: position, reference and alternative alleles, MAF, fraction of missing calls.
+        """
+        with open(outp, 'wb') as f:
+            f.writelines(self.excluded)
+
+
+class VcfStats(object):
+    """
+    Statistics of vcf file collected block by block: for every SNP number of missing calls and frequency of
+    alternative alleles, for every patient number of calls.
+    """
+
+    def __init__(self, pat):
+        self.pat = pat
+        self.missing = []
+        self.af = []
+        self.called = np.zeros(shape=(pat,), dtype=np.int64)
+
+    def add(self, first, second):
+        called = (first != -1) & (second != -1)
+        ncalled = called.sum(axis=1)
+        alt = ((first > 0) & called).sum(axis=1) + ((second > 0) & called).sum(axis=1)
+        self.missing.append((self.pat - ncalled).astype(np.int32))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.af.append((alt / (2 * ncalled)).astype(np.float32))
+        self.called += called.sum(axis=0)
+
+    def merge(self, other):
+        self.missing += other.missing
+        self.af += other.af
+        self.called += other.called
+
+    def write(self, outp, pids):
+        """
+        Writing statistics: number of SNPs, number of patients and their identifiers into text file outp (as
+        vcf_stats.py always did) and arrays snp_missing (fraction of missing calls), snp_af (frequency of alternative
+        alleles, nan if there are no calls) and sample_callrate into npz file next to it.
+        """
+        missing = np.concatenate(self.missing) if self.missing else np.zeros(shape=(0,), dtype=np.int32)
+        af = np.concatenate(self.af) if self.af else np.zeros(shape=(0,), dtype=np.float32)
+        snp = missing.shape[0]
+        with open(outp, 'w') as p:
+            p.write('Number of SNPs:\t%d\nNumber of patients:\t%d\nPatients identifiers:\n%s' %
+                    (snp, self.pat, ''.join([el + '\n' for el in pids])))
+        np.savez(outp.replace('.txt', '') + '.npz', snp_missing=(missing / max(self.pat, 1)).astype(np.float32),
+                 snp_af=af, sample_callrate=(self.called / max(snp, 1)).astype(np.float32))
+        return snp
+
+
+def stats_file(inp):
+    """
+    Name of file with statistics of vcf file inp (the same as always written by vcf_stats.py).
+    """
+    return inp.split('.')[0] + '_stats.txt'
+
+
+def is_snp(ref, alt):
+    """
+    Checking if vcf record is SNP (the same rule as SelectVariants -select-type-to-include SNP): reference and all
+    alternative alleles are single nucleobases, records with symbolic alleles (<DEL>, *), breakends and without
+    alternative allele (.) are not SNPs.
+    :param ref: (bytes) REF field of the record
+    :param alt: (bytes) ALT field of the record
+    :return: (bool)
+    """
+    if ref not in BASES:
+        return False
+    for allele in alt.split(b','):
+        if allele not in BASES:
+            return False
+    return True
+
+
+def select_snps(lines):
+    """
+    Leaving only SNP records (see is_snp) from block of raw lines of vcf records.
+    """
+    selected = []
+    for line in lines:
+        fields = line.split(b'\t', 5)
+        if is_snp(fields[3], fields[4]):
+            selected.append(line)
+    return selected
+
+
+def decode_records(lines, pat, snps_only=False, mask=None, cols=None):
+    """
+    Decoding one block of records (first stage of parse_records, it does not change any state, so blocks can be
+    decoded by many threads at once).
+    :return: (tuple) lines (only SNPs if snps_only), values of the first and the second allele, calls of low quality
+    (or None)
+    """
+    if snps_only:
+        lines = select_snps(lines)
+        if not lines:
+            return lines, None, None, None
+    first, second = decode_block(lines, pat, cols)
+    fail = mask.failing(lines, second, pat, cols) if mask is not None else None
+    return lines, first, second, fail
+
+
+def write_records(lines, first, second, fail, pat, s, stats=None, mask=None, cols=None, qc=None):
+    """
+    Second stage of parse_records - masking, statistics, quality control of SNPs and writing descriptions of SNPs,
+    blocks have to be given in the order of the file.
+    :return: matrix SNPs x patients which should be written, None if no SNP from the block is written
+    """
+    if not lines:
+        return None
+    if mask is not None:
+        mask.apply(lines, first, second, pat, cols, fail)
+    if stats is not None:
+        stats.add(first, second)
+    if qc is not None:
+        keep = qc.select(lines, first, second)
+        if mask is not None:
+            mask.select(keep)
+        if not keep.all():
+            lines = [line for line, k in zip(lines, keep) if k]
+            second = second[keep]
+        if not lines:
+            return None
+    for line in lines:
+        line = line.split(b'\t', 5)
+        s.write(b'%s\t%s\t%s\n' % (line[1], line[3], line[4]))
+    return second
+
+
+class StageTimer(object):
+    """
+    Collecting time and amount of work (records, bytes) of one stage of pipelined parsing.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.time = 0.
+        self.records = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds, records, nbytes=0):
+        with self.lock:
+            self.time += seconds
+            self.records += records
+            self.bytes += nbytes
+
+    def __str__(self):
+        rate = self.records / self.time if self.time else 0.
+        return '%s: %d records, %.1f MB, %.2f s busy, %.0f records/s' % (self.name, self.records, self.bytes / 2**20,
+                                                                          self.time, rate)
+
+
+def read_stage(lines, blocks, timer):
+    """
+    Reader thread of pipelined parsing - putting blocks of raw lines into bounded queue, None at the end (or an
+    exception if reading failed).
+    """
+    try:
+        start = time.time()
+        for block in read_blocks(lines):
+            timer.add(time.time() - start, len(block), sum([len(line) for line in block]))
+            blocks.put(block)
+            start = time.time()
+        blocks.put(None)
+    except Exception as e:
+        blocks.put(e)
+
+
+def pipelined_records(lines, pat, s, stats=None, snps_only=False, mask=None, cols=None, qc=None, workers=2,
+                      depth=None):
+    """
+    Pipelined version of parse_records: reader thread reads blocks of lines (and decompresses them) into bounded queue,
+    pool of workers decodes them, the caller writes them in the order of the file. At most depth blocks are waiting
+    in the queue and at most depth blocks are decoded at once, so memory is bounded. Throughput of every stage is
+    written to standard error at the end.
+    """
+    if depth is None:
+        depth = 2 * workers
+    timers = [StageTimer('read'), StageTimer('decode'), StageTimer('write')]
+    blocks = queue.Queue(maxsize=depth)
+    reader = threading.Thread(target=read_stage, args=(lines, blocks, timers[0]), daemon=True)
+    reader.start()
+
+    def decode(block):
+        start = time.time()
+        result = decode_records(block, pat, snps_only, mask, cols)
+        timers[1].add(time.time() - start, len(block))
+        return result
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+    end = False
+    try:
+        while True:
+            while not end and len(pending) < depth:
+                block = blocks.get()
+                if isinstance(block, Exception):
+                    raise block
+                if block is None:
+                    end = True
+                    break
+                pending.append(pool.submit(decode, block))
+            if not pending:
+                break
+            result = pending.popleft().result()
+            start = time.time()
+            values = write_records(*result[:4], pat, s, stats, mask, cols, qc)
+            timers[2].add(time.time() - start, len(result[0]))
+            if values is not None:
+                yield values
+    finally:
+        pool.shutdown(wait=True)
+    reader.join()
+    for timer in timers:
+        sys.stderr.write('%s\n' % timer)
+
+
+def parse_records(lines, pat, s, stats=None, snps_only=False, mask=None, cols=None, qc=None, workers=1):
+    """
+    Parsing vcf records in blocks - writing description of every SNP (position, reference and alternative alleles)
+    into file s and giving back decoded genotypes.
+    :param lines: (iterable) raw lines of vcf records, e.g. file object after the header
+    :param pat: (int) number of patients
+    :param s: binary file for descriptions of SNPs (snps_chr file)
+    :param stats: (VcfStats) if given, statistics are collected in the same pass
+    :param snps_only: (bool) if records other than SNPs should be skipped (they are not decoded)
+    :param mask: (QualityMask) if given, calls of low quality are changed into missing calls
+    :param cols: (array-like) numbers of sample fields which should be decoded, all if None
+    :param qc: (VariantFilter) if given, SNPs which do not pass it are not written (statistics are collected for all
+    SNPs)
+    :param workers: (int) number of threads decoding blocks, if more than 1, reading, decoding and writing are
+    pipelined (see pipelined_records)
+    :return: generator of matrices SNPs x patients (selected patients)
+    """
+    if workers > 1:
+        for values in pipelined_records(lines, pat, s, stats, snps_only, mask, cols, qc, workers):
+            yield values
+        return
+    for lines in read_blocks(lines):
+        values = write_records(*decode_records(lines, pat, snps_only, mask, cols), pat, s, stats, mask, cols, qc)
+        if values is not None:
+            yield values
+
+
+def split_ranges(inp, start, procs):
+    """
+    Dividing uncompressed vcf file (from byte start, i.e. the first record) into at most procs byte ranges which begin
+    and end at boundaries of lines.
+    :return: (list) pairs (start, end)
+    """
+    size = os.path.getsize(inp)
+    bounds = [start]
+    with open(inp, 'rb') as o:
+        for k in range(1, procs):
+            pos = start + (size - start) * k // procs
+            if pos <= bounds[-1]:
+                continue
+            o.seek(pos - 1)
+            o.readline()
+            bounds.append(o.tell())
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def read_range(o, start, end):
+    """
+    Giving back lines of file o which begin in byte range [start, end).
+    """
+    o.seek(start)
+    pos = start
+    while pos < end:
+        line = o.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line
+
+
+def parse_range(args):
+    """
+    Parsing one byte range of vcf file (function for the pool of processes). Genotypes are written SNP-major into
+    file {part}.int8, descriptions of SNPs into {part}.snps.
+    :param args: (tuple) path to vcf file, start and end of the range, number of patients, prefix of output files,
+    if statistics should be collected, if only SNP records should be parsed, thresholds of quality of calls (pair
+    min_gq, min_dp, or None), numbers of sample fields which should be decoded (or None), thresholds of quality
+    control of SNPs (pair min_maf, max_missing, or None)
+    :return: prefix of output files, number of parsed SNPs, statistics of the range (VcfStats or None), masked calls
+    (QualityMask or None), excluded SNPs (VariantFilter or None)
+    """
+    inp, start, end, pat, part, stats, snps_only, mask, cols, qc = args
+    snp = 0
+    if stats:
+        stats = VcfStats(pat if cols is None else len(cols))
+    else:
+        stats = None
+    if mask is not None:
+        mask = QualityMask(*mask)
+    if qc is not None:
+        qc = VariantFilter(*qc)
+    with open(inp, 'rb') as o, open(part + '.int8', 'wb') as x, open(part + '.snps', 'wb') as s:
+        for values in parse_records(read_range(o, start, end), pat, s, stats, snps_only, mask, cols, qc):
+            values.tofile(x)
+            snp += values.shape[0]
+    return part, snp, stats, mask, qc
+
+
+def part_blocks(parts, pat, chunk=CHUNK):
+    """
+    Giving back SNP-major blocks of genotypes from files written by parse_range, in the order of parts.
+    """
+    for part, snp in parts:
+        if snp:
+            values = np.memmap(part + '.int8', dtype=np.int8, mode='r', shape=(snp, pat))
+            for start in range(0, snp, chunk):
+                yield values[start:start+chunk]
+            del values
+
+
+def copy_part(args):
+    """
+    Copying genotypes parsed by parse_range into their columns of npy matrix patients x SNPs (function for the pool
+    of processes - every process writes into different columns of the same file).
+    :param args: (tuple) name of npy file, prefix of part files, number of SNPs in the part, first column of the part
+    """
+    xfile, part, snp, offset = args
+    X = np.load(xfile, mmap_mode='r+')
+    for values in part_blocks([(part, snp)], X.shape[0]):
+        X[:, offset:offset+values.shape[0]] = values.T
+        offset += values.shape[0]
+    X.flush()
+    del X
@@ -1,40 +1,45 @@
 import sys
+import vcf_funcs as vfuncs
 
 '''
 See readme.txt for input, output and possible options.
 '''
 
 
-def run_stats(inp, outp):
+def run_stats(inp, outp, threads=1, snps_only=False):
+    """
+    Streaming statistics of vcf file - records are decoded block by block, so only one block is kept in memory.
+    """
 
-    o = open(inp, 'r')
+    o = vfuncs.open_vcf(inp, threads)
 
-    header = 0
     for line in o:
-        if not line.startswith('##'):
+        if not line.startswith(b'##'):
             break
-        header += 1
 
-    pat = 0
+    pids = line.decode().split()[9:]
+    stats = vfuncs.VcfStats(len(pids))
+    for lines in vfuncs.read_blocks(o):
+        if snps_only:
+            lines = vfuncs.select_snps(lines)
+            if not lines:
+                continue
+        stats.add(*vfuncs.decode_block(lines, len(pids)))
 
-    p = open(outp, 'w')
-    string = ''
-    line = line.split()
-    for el in line[9:]:
-        string += el + '\n'
-        pat += 1
-      
-    snp = len(o.readlines())
-
-    p.write('Number of SNPs:\t%d\nNumber of patients:\t%d\nPatients identifiers:\n%s' % (snp, pat, string))
-    p.close()
+    stats.write(outp, pids)
     o.close()
 
 
 inp = ''
+threads = 1
+snps_only = False
 for q in range(len(sys.argv)):
     if sys.argv[q] == '-input':
         inp = sys.argv[q+1]
+    if sys.argv[q] == '-threads':
+        threads = int(sys.argv[q+1])
+    if sys.argv[q] == '-snps_only':
+        snps_only = True
 
-outp = inp.split('.')[0]+'_stats.txt'
-run_stats(inp, outp)
+outp = vfuncs.stats_file(inp)
+run_stats(inp, outp, threads, snps_only)
@@ -1,36 +1,67 @@
+import filecmp
+import itertools
+import multiprocessing
 import numpy as np
+import os
+import shutil
 import sys
 sys.path.insert(0, '../')
 import exceptions
+import corporate_funcs as funcs
+import vcf_funcs as vfuncs
 
 '''
 See readme.txt for input, output and possible options.
 '''
 
 
-def vcf_to_matrix(ch, inp, outdir):
-
-    o = open(inp, 'r')
-
+def read_header(o, ch, outdir, append=False, keep=None):
+    """
+    Skipping meta-information lines of vcf file, writing IDs of patients from the header line into pid_chr file.
+    :param append: (bool) if patients are added to existing pid_chr file - IDs are only checked (they cannot be
+    already there), they are written by vcf_to_matrix_append
+    :param keep: (set) IDs of patients which should be parsed, all if None
+    :return: (tuple) IDs of all patients in the file, IDs of selected patients, numbers of their sample fields (None
+    if all patients are selected)
+    """
     line = o.readline()
-    while line.startswith('##'):
+    while line.startswith(b'##'):
         line = o.readline()
 
+    allpids = [el.strip() for el in line.decode().split()[9:]]
+    pids, cols = vfuncs.select_patients(allpids, keep)
+    if append:
+        with open('%spid_chr%s.txt' % (outdir, ch), 'r') as p:
+            old = set([el.strip() for el in p if el.strip()])
+        for pid in pids:
+            if pid in old:
+                raise exceptions.OtherError('Patient %s is already in %spid_chr%s.txt!' % (pid, outdir, ch))
+        return allpids, pids, cols
+
+    if ch is not None:
+        write_pids(outdir, ch, pids)
+
+    return allpids, pids, cols
+
+
+def write_pids(outdir, ch, pids):
     p = open('%spid_chr%s.txt' % (outdir, ch), 'w')
-    line = line.split()
-    for pat, el in enumerate(line[9:]):
-        p.write(el.strip() + '\n')
-    pat += 1
-    header = o.tell()
+    for pid in pids:
+        p.write(pid + '\n')
     p.close()
 
-    for snp, _ in enumerate(o):
-        pass
-    snp += 1
-        
-    o.seek(header)
 
-    s = open('%ssnps_chr%s.txt' % (outdir, ch), 'w')
+def vcf_to_matrix(ch, inp, outdir, spill=None, threads=1, csv=False, packed=False, stats=False, snps_only=False,
+                  regions=None, quality=None, keep=None, qc=None, workers=1):
+
+    o = vfuncs.open_vcf(inp, threads)
+    allpids, pids, cols = read_header(o, ch, outdir, keep=keep)
+    pat = len(pids)
+    if regions:
+        # only records from the regions are read, starting from offsets given by the index
+        o.close()
+        o = vfuncs.region_lines(inp, regions, threads)
+
     '''
     matrix = np.zeros(shape=(pat, snp, 2), dtype=np.int8)
     for i, line in enumerate(o):
@@ -51,28 +82,281 @@ def vcf_to_matrix(ch, inp, outdir):
     np.save('%smatrix_chr%s.npy' % (outdir, ch), matrix)     
     '''
 
-    X = np.zeros(shape=(pat, snp+1), dtype=np.int8)
-    for i, line in enumerate(o):
-        line = line.split()
-        s.write('%s\t%s\t%s\n' % (line[1], line[3], line[4]))
-        for j, e in enumerate(line[9:]):
-            X[j][0] = j
-            try:
-                v = int(e.split(':')[0].replace('|', '/').split('/')[1])
-            except ValueError:
-                v = -1
-            X[j, i+1] = v
+    if stats:
+        stats = vfuncs.VcfStats(pat)
+    else:
+        stats = None
+    snp = parse_chromosome(ch, o, outdir, len(allpids), cols, spill, csv, packed, stats, snps_only, quality, qc,
+                           workers)
+    if stats is not None:
+        stats.write(vfuncs.stats_file(inp), pids)
+    o.close()
+
+    return "%s\t%d\t%d" % (ch, snp, pat)
+
+
+def parse_chromosome(ch, lines, outdir, npat, cols=None, spill=None, csv=False, packed=False, stats=None,
+                     snps_only=False, quality=None, qc=None, workers=1):
+    """
+    Parsing vcf records of one chromosome, writing snps_chr file and X_chr matrix (and masked_chr, excluded_chr files
+    if quality masking or quality control of SNPs is used).
+    :param lines: (iterable) raw lines of vcf records
+    :param npat: (int) number of patients in vcf file
+    :param cols: (list) numbers of sample fields of selected patients, all if None
+    :param stats: (VcfStats) statistics which should be collected, or None
+    :param workers: (int) number of threads decoding records (reading, decoding and writing are pipelined if more
+    than 1)
+    :return: (int) number of written SNPs
+    """
+    pat = npat if cols is None else len(cols)
+    s = open('%ssnps_chr%s.txt' % (outdir, ch), 'wb')
+
+    # single pass through the file - values are collected in growable buffer, number of SNPs is known at the end
+    buffer = vfuncs.GenotypeBuffer(pat, spill=spill)
+    mask = vfuncs.QualityMask(*quality) if quality is not None else None
+    qc = vfuncs.VariantFilter(*qc) if qc is not None else None
+    for values in vfuncs.parse_records(lines, npat, s, stats, snps_only, mask, cols, qc, workers):
+        buffer.append(values)
+    snp = buffer.snp
+    s.close()
+    if qc is not None:
+        qc.write('%sexcluded_chr%s.txt' % (outdir, ch))
+    if mask is not None:
+        np.save('%smasked_chr%s.npy' % (outdir, ch), mask.counts())
+
+    if packed:
+        # buffer is SNP-major, so it can be packed block by block
+        funcs.save_packed('%sX_chr%s.gtp' % (outdir, ch), pat, snp, buffer.blocks())
+        if csv:
+            X, _, _ = funcs.load_packed('%sX_chr%s.gtp' % (outdir, ch))
+            funcs.save_csv(funcs.unpack_genotypes(X, pat), '%sX_chr%s.csv' % (outdir, ch))
+    else:
+        X = np.lib.format.open_memmap('%sX_chr%s.npy' % (outdir, ch), mode='w+', dtype=np.int8, shape=(pat, snp))
+        buffer.finalize(out=X)
+        if csv:
+            funcs.save_csv(X, '%sX_chr%s.csv' % (outdir, ch))
+        X.flush()
+        del X
+
+    return snp
 
-    np.savetxt('%sX_chr%s.csv' % (outdir, ch), X, fmt='%d', delimiter=',',
-               header=','+','.join(list(map(str, range(snp)))), comments='')
+
+def vcf_to_matrix_split(inp, outdir, spill=None, threads=1, csv=False, packed=False, stats=False, snps_only=False,
+                        regions=None, quality=None, keep=None, qc=None, workers=1):
+    """
+    Processing genome-wide vcf file in one pass - records are routed by CHROM column into matrices of their
+    chromosomes (X is named 23, Y is named 24). Records of every chromosome have to be in one piece of the file,
+    chromosome is written when its records end, so only one chromosome is kept in memory. Numbers of SNPs and
+    patients are written only into genome_stats.txt, summary message is returned.
+    """
+    o = vfuncs.open_vcf(inp, threads)
+    allpids, pids, cols = read_header(o, None, outdir, keep=keep)
+    pat = len(pids)
+    lines = o
+    if regions:
+        lines = vfuncs.region_lines(inp, regions, threads)
+
+    if stats:
+        stats = vfuncs.VcfStats(pat)
+    else:
+        stats = None
+    done = []
+    genome = []
+    for chrom, records in itertools.groupby(lines, key=lambda line: line.split(b'\t', 1)[0]):
+        if not chrom.strip():
+            continue  # empty lines
+        ch = vfuncs.chrom_name(chrom)
+        if ch in done:
+            raise exceptions.OtherError('Records of chromosome %s are not in one piece of %s!' % (ch, inp))
+        done.append(ch)
+        write_pids(outdir, ch, pids)
+        snp = parse_chromosome(ch, records, outdir, len(allpids), cols, spill, csv, packed, stats, snps_only,
+                               quality, qc, workers)
+        genome.append((ch, snp))
+    if stats is not None:
+        stats.write(vfuncs.stats_file(inp), pids)
+    if regions:
+        lines.close()
+    o.close()
+
+    genome.sort(key=lambda g: (not g[0].isdigit(), int(g[0]) if g[0].isdigit() else 0, g[0]))
+    with open('%sgenome_stats.txt' % outdir, 'w') as g:
+        for ch, snp in genome:
+            g.write('%s\t%d\t%d\n' % (ch, snp, pat))
+
+    return 'Chromosomes %s written, number of patients: %d' % (', '.join([ch for ch, _ in genome]), pat)
+
+
+def vcf_to_matrix_append(ch, inp, outdir, spill=None, threads=1, csv=False, stats=False, snps_only=False,
+                         regions=None, quality=None, keep=None, workers=1):
+    """
+    Adding patients from new vcf file to existing matrices of the chromosome. SNPs of the new file have to be the same
+    as in snps_chr file, only genotypes of new patients are decoded and appended to X_chr matrix (npy, packed and csv
+    file, which exist), pid_chr file and genome_stats.txt.
+    """
+    snpfile = '%ssnps_chr%s.txt' % (outdir, ch)
+    newfile = '%ssnps_chr%s_append.txt' % (outdir, ch)
+    for file in [snpfile, '%spid_chr%s.txt' % (outdir, ch)]:
+        if not os.path.isfile(file):
+            raise exceptions.NoFileError(file)
+
+    o = vfuncs.open_vcf(inp, threads)
+    allpids, pids, cols = read_header(o, ch, outdir, append=True, keep=keep)
+    pat = len(pids)
+    if regions:
+        o.close()
+        o = vfuncs.region_lines(inp, regions, threads)
+
+    s = open(newfile, 'wb')
+    buffer = vfuncs.GenotypeBuffer(pat, spill=spill)
+    if stats:
+        stats = vfuncs.VcfStats(pat)
+    else:
+        stats = None
+    mask = vfuncs.QualityMask(*quality) if quality is not None else None
+    for values in vfuncs.parse_records(o, len(allpids), s, stats, snps_only, mask, cols, workers=workers):
+        buffer.append(values)
     o.close()
     s.close()
+    if stats is not None:
+        stats.write(vfuncs.stats_file(inp), pids)
+
+    if not filecmp.cmp(snpfile, newfile, shallow=False):
+        os.remove(newfile)
+        raise exceptions.OtherError('SNPs in %s are different than in %s, patients cannot be appended!' %
+                                    (inp, snpfile))
+    os.remove(newfile)
+    snp = buffer.snp
+    X = buffer.finalize()
+
+    npy = '%sX_chr%s.npy' % (outdir, ch)
+    gtp = '%sX_chr%s.gtp' % (outdir, ch)
+    if os.path.isfile(npy):
+        old = funcs.append_rows(npy, X)[0] - pat
+    elif os.path.isfile(gtp):
+        old = funcs.append_packed(gtp, X) - pat
+    else:
+        raise exceptions.NoFileError('X_chr%s.npy' % ch)
+    if csv and os.path.isfile('%sX_chr%s.csv' % (outdir, ch)):
+        funcs.append_csv(X, '%sX_chr%s.csv' % (outdir, ch), old)
+
+    with open('%spid_chr%s.txt' % (outdir, ch), 'a') as p:
+        for pid in pids:
+            p.write(pid + '\n')
+    update_genome_stats(outdir, ch, old + pat)
+    if mask is not None:
+        masked = mask.counts()
+        if os.path.isfile('%smasked_chr%s.npy' % (outdir, ch)):
+            masked = masked + np.load('%smasked_chr%s.npy' % (outdir, ch))
+        np.save('%smasked_chr%s.npy' % (outdir, ch), masked)
+
+    return "%s\t%d\t%d" % (ch, snp, old + pat)
+
+
+def update_genome_stats(outdir, ch, pat):
+    """
+    Changing number of patients of the chromosome in genome_stats.txt (if the file exists) - in every column after
+    number of SNPs (also in the column added by makeY.py).
+    """
+    if not os.path.isfile('%sgenome_stats.txt' % outdir):
+        return None
+    with open('%sgenome_stats.txt' % outdir, 'r') as g:
+        lines = g.readlines()
+    with open('%sgenome_stats.txt' % outdir, 'w') as g:
+        for line in lines:
+            line = line.strip().split('\t')
+            if line[0] == ch:
+                line[2:] = [str(pat)] * len(line[2:])
+            g.write('\t'.join(line) + '\n')
+    return None
+
+
+def vcf_to_matrix_parallel(ch, inp, outdir, procs, spill=None, csv=False, packed=False, stats=False,
+                           snps_only=False, quality=None, keep=None, qc=None):
+    """
+    Processing one (uncompressed) vcf file by procs processes. File is divided into byte ranges beginning at line
+    boundaries, every range is parsed by different process into temporary files, then the parts are written into
+    their (disjoint) blocks of columns of the output matrix and descriptions of SNPs are joined in the order of the
+    file.
+    """
+
+    with open(inp, 'rb') as o:
+        allpids, pids, cols = read_header(o, ch, outdir, keep=keep)
+        start = o.tell()
+    pat = len(pids)
+
+    if spill is None:
+        spill = outdir
+    ranges = vfuncs.split_ranges(inp, start, procs)
+    pool = multiprocessing.Pool(procs)
+    parts = pool.map(vfuncs.parse_range, [(inp, a, b, len(allpids), '%sX_chr%s_part%d' % (spill, ch, i), stats,
+                                           snps_only, quality, cols, qc) for i, (a, b) in enumerate(ranges)])
+    if stats:
+        stats = vfuncs.VcfStats(pat)
+        for _, _, part_stats, _, _ in parts:
+            stats.merge(part_stats)
+        stats.write(vfuncs.stats_file(inp), pids)
+    if quality is not None:
+        mask = vfuncs.QualityMask(*quality)
+        for _, _, _, part_mask, _ in parts:
+            mask.merge(part_mask)
+        np.save('%smasked_chr%s.npy' % (outdir, ch), mask.counts())
+    if qc is not None:
+        qc = vfuncs.VariantFilter(*qc)
+        for _, _, _, _, part_qc in parts:
+            qc.merge(part_qc)
+        qc.write('%sexcluded_chr%s.txt' % (outdir, ch))
+    parts = [(part, n) for part, n, _, _, _ in parts]
+
+    with open('%ssnps_chr%s.txt' % (outdir, ch), 'wb') as s:
+        for part, _ in parts:
+            with open(part + '.snps', 'rb') as ps:
+                shutil.copyfileobj(ps, s)
+    snp = sum([n for _, n in parts])
+
+    if packed:
+        funcs.save_packed('%sX_chr%s.gtp' % (outdir, ch), pat, snp, vfuncs.part_blocks(parts, pat))
+        if csv:
+            X, _, _ = funcs.load_packed('%sX_chr%s.gtp' % (outdir, ch))
+            funcs.save_csv(funcs.unpack_genotypes(X, pat), '%sX_chr%s.csv' % (outdir, ch))
+    else:
+        xfile = '%sX_chr%s.npy' % (outdir, ch)
+        X = np.lib.format.open_memmap(xfile, mode='w+', dtype=np.int8, shape=(pat, snp))
+        del X
+        offsets = np.cumsum([0] + [n for _, n in parts])
+        pool.map(vfuncs.copy_part, [(xfile, part, n, offset) for (part, n), offset in zip(parts, offsets)])
+        if csv:
+            funcs.save_csv(np.load(xfile, mmap_mode='r'), '%sX_chr%s.csv' % (outdir, ch))
+    pool.close()
+    pool.join()
+
+    for part, _ in parts:
+        os.remove(part + '.int8')
+        os.remove(part + '.snps')
 
     return "%s\t%d\t%d" % (ch, snp, pat)
 
 
 ch = '1'
 outdir = './'
+spill = None
+threads = 1
+csv = False
+packed = False
+procs = 1
+stats = False
+snps_only = False
+region = None
+bed = None
+append = False
+min_gq = None
+min_dp = None
+keepfile = None
+diagfile = None
+min_maf = None
+max_missing = None
+split = False
+workers = 1
 for q in range(len(sys.argv)):
     if sys.argv[q] == '-chr':
         ch = sys.argv[q+1]
@@ -80,8 +364,67 @@ for q in range(len(sys.argv)):
         inp = sys.argv[q+1]
     if sys.argv[q] == '-outdir':
         outdir = sys.argv[q+1]
+    if sys.argv[q] == '-spill':
+        spill = sys.argv[q+1]
+    if sys.argv[q] == '-threads':
+        threads = int(sys.argv[q+1])
+    if sys.argv[q] == '-csv':
+        csv = True
+    if sys.argv[q] == '-packed':
+        packed = True
+    if sys.argv[q] == '-procs':
+        procs = int(sys.argv[q+1])
+    if sys.argv[q] == '-stats':
+        stats = True
+    if sys.argv[q] == '-snps_only':
+        snps_only = True
+    if sys.argv[q] == '-region':
+        region = sys.argv[q+1]
+    if sys.argv[q] == '-regions':
+        bed = sys.argv[q+1]
+    if sys.argv[q] == '-append':
+        append = True
+    if sys.argv[q] == '-min_gq':
+        min_gq = int(sys.argv[q+1])
+    if sys.argv[q] == '-min_dp':
+        min_dp = int(sys.argv[q+1])
+    if sys.argv[q] == '-keep':
+        keepfile = sys.argv[q+1]
+    if sys.argv[q] == '-diagnoses':
+        diagfile = sys.argv[q+1]
+    if sys.argv[q] == '-min_maf':
+        min_maf = float(sys.argv[q+1])
+    if sys.argv[q] == '-max_missing':
+        max_missing = float(sys.argv[q+1])
+    if sys.argv[q] == '-split':
+        split = True
+    if sys.argv[q] == '-workers':
+        workers = int(sys.argv[q+1])
 
 if 'inp' not in globals():
     raise exceptions.NoParameterError('inp', 'name of input file')
 
-print(vcf_to_matrix(ch, inp, outdir))
+regions = vfuncs.parse_regions(region, bed)
+quality = (min_gq, min_dp) if min_gq is not None or min_dp is not None else None
+keep = vfuncs.read_keep(keepfile, diagfile)
+qc = (min_maf, max_missing) if min_maf is not None or max_missing is not None else None
+if append and qc is not None:
+    raise exceptions.OtherError('SNPs cannot be filtered (-min_maf, -max_missing) while patients are appended!')
+
+if split and procs > 1:
+    raise exceptions.OtherError('Genome-wide vcf file (-split) cannot be parsed by many processes (-procs), use '
+                                '-workers instead!')
+
+if split:
+    # genome_stats.txt is written by vcf_to_matrix_split, summary goes to standard error, so stdout redirected into
+    # genome_stats.txt (as in prepreparing.sh) does not duplicate its rows
+    print(vcf_to_matrix_split(inp, outdir, spill, threads, csv, packed, stats, snps_only, regions, quality, keep, qc,
+                              workers), file=sys.stderr)
+elif append:
+    print(vcf_to_matrix_append(ch, inp, outdir, spill, threads, csv, stats, snps_only, regions, quality, keep,
+                               workers))
+elif procs > 1 and not vfuncs.is_compressed(inp) and not regions:
+    print(vcf_to_matrix_parallel(ch, inp, outdir, procs, spill, csv, packed, stats, snps_only, quality, keep, qc))
+else:
+    print(vcf_to_matrix(ch, inp, outdir, spill, threads, csv, packed, stats, snps_only, regions, quality, keep,
+                        qc, workers))